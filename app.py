@@ -1,10 +1,18 @@
 # app.py
-from flask import Flask, render_template, request
-import itertools, random, urllib.parse, requests, datetime, time, uuid, sys, re, threading, os
-from collections import defaultdict
+from flask import Flask, render_template, request, make_response
+from markupsafe import escape
+import itertools, random, urllib.parse, requests, datetime, time, uuid, sys, re, threading, os, bisect, heapq, math, queue
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, Future, wait as futures_wait
+import hashlib, hmac, atexit, sqlite3, json, multiprocessing
+import urllib3
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from nacl.signing import VerifyKey
+try:
+    import numpy as np
+except ImportError:  # NumPy 없으면 순수 파이썬 탐색만 사용
+    np = None
 
 app = Flask(__name__)
 
@@ -16,6 +24,8 @@ positions = ["탑", "정글", "미드", "원딜", "서폿"]
 # GAS 릴레이 (Discord Webhook 프록시)
 RELAY_BASE = 'https://script.google.com/macros/s/AKfycbyrVfddMN363ZhuBJH09es1MEmPC6lwhbyncXauc7I_Fh51GL7gJTx11bJdIddV7czmTg/exec'
 RELAY_KEY  = 'hawawasiegetan'  # GAS SHARED_KEY
+# 관리용 POST(점수 갱신, pending 정리, 전체 재동기화) 공유 키: X-Admin-Key 헤더로만 받는다. 비어 있으면 모두 거절
+ADMIN_KEY = os.environ.get("ADMIN_KEY", "").strip()
 print(">>> LOADED: app.py")
 # Discord Interactions 서명 검증 키
 DISCORD_PUBLIC_KEY = os.environ.get("DISCORD_PUBLIC_KEY", "").strip()
@@ -25,25 +35,90 @@ SHEET_NAME = "hawawa_db"
 CREDS_FILE = "hawawa-teambuilder-e8bc633550b7.json"
 SCORES_WS = "기록장"
 PENDING_WS = "pending"
+SHEET_KEY = os.environ.get("SHEET_KEY", "").strip()   # 있으면 이름 검색(Drive) 없이 key로 바로 연다
+SHEETS_QUOTA_PER_MIN = int(os.environ.get("SHEETS_QUOTA_PER_MIN", "60"))  # 경고 기준(분당 호출 수)
+BATCH_MAX_ROWS = int(os.environ.get("BATCH_MAX_ROWS", "20"))       # 쓰기 대기 건수가 이만큼 쌓이면 바로 flush
+BATCH_FLUSH_SEC = float(os.environ.get("BATCH_FLUSH_SEC", "2.0"))  # 아니면 이 시간 뒤 flush
+BATCH_WAIT_SEC = float(os.environ.get("BATCH_WAIT_SEC", "60"))     # 내 행의 결과(Future)를 기다리는 최대 시간
+PENDING_ARCHIVE_WS = "pending_archive"
+PENDING_COMPACT_AT = int(os.environ.get("PENDING_COMPACT_AT", "200"))      # Done 행이 이만큼 쌓이면 보관 시트로 이동
+PENDING_RELOAD_SEC = float(os.environ.get("PENDING_RELOAD_SEC", "600"))    # 다른 프로세스/수동 수정 반영 주기
+JOURNAL_DB = os.environ.get("JOURNAL_DB", "journal.db")                    # 결과 쓰기 저널(SQLite)
+JOURNAL_RETRY_MAX = float(os.environ.get("JOURNAL_RETRY_MAX", "300"))      # 재시도 간격 상한(초)
+JOURNAL_LEASE_SEC = float(os.environ.get("JOURNAL_LEASE_SEC", str(2 * BATCH_WAIT_SEC + 60)))  # 재생 중인 항목 점유 시간
+MIRROR_DB = os.environ.get("MIRROR_DB", "mirror.db")                       # 기록장/결과 시트 로컬 사본(SQLite)
+MIRROR_SYNC_SEC = float(os.environ.get("MIRROR_SYNC_SEC", "300"))          # 결과 시트 증분 동기화 주기
+MATCH_DB = os.environ.get("MATCH_DB", "matches.db")                        # 조합 ID 등록부(SQLite)
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", "256"))            # 렌더링한 페이지(/조합코드, /) 캐시 개수
+
+# 점수표 캐시: TTL(초) 안에는 그대로, TTL~MAX_STALE 사이는 옛 값 반환 + 백그라운드 갱신
+SCORES_TTL = float(os.environ.get("SCORES_TTL", "60"))
+SCORES_MAX_STALE = float(os.environ.get("SCORES_MAX_STALE", "900"))
+
+# 저장소 백엔드: "sheets"(구글 시트) | "memory"(프로세스 메모리) | "sqlite"(STORAGE_DB 파일)
+#  - memory/sqlite는 부하 테스트/벤치마크용. STORAGE_SEED(JSON {"시트이름": [[행]...], "sheet1": 결과 행})로 초기 데이터
+#  - STORAGE_LATENCY_MS(+0~STORAGE_JITTER_MS)만큼 매 호출을 늦춰 시트 왕복 시간을 흉내 낸다
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sheets").strip().lower()
+STORAGE_DB = os.environ.get("STORAGE_DB", "storage.db")
+STORAGE_SEED = os.environ.get("STORAGE_SEED", "").strip()
+STORAGE_LATENCY_MS = float(os.environ.get("STORAGE_LATENCY_MS", "0"))
+STORAGE_JITTER_MS = float(os.environ.get("STORAGE_JITTER_MS", "0"))
 
 # 우리 서비스 기본 URL
 BASE_URL = "https://seigetan.pythonanywhere.com"
 
-# 속도 제한
-LAST_SEND_TS = 0.0
-MIN_INTERVAL = 1.0  # 초당 1건
-
-# 웹 폼 투표(기존) 저장소
-POLLS = {}
-
-# 슬래시 익명 투표용 최신 세트(3개 조합)
-CURRENT_POLL = {
-    "options": [],        # ["1번","2번","3번"]
-    "option_links": [],   # ["https://.../조합코드?a=..&b=..", ...]
-    "votes": {},          # {user_id: idx}
-    "created_at": 0
-}
-POLL_LOCK = threading.Lock()
+# 조합 탐색 백엔드: "python" | "numpy" (NumPy 미설치 시 python으로 폴백)
+MATCH_BACKEND = os.environ.get("MATCH_BACKEND", "python").strip().lower()
+
+# 조합 추첨 엔진: "exhaustive"(전수 풀에서 추첨) | "sampling"(풀 없이 무작위 분할/배치 표본 추출)
+MATCH_ENGINE = os.environ.get("MATCH_ENGINE", "exhaustive").strip().lower()
+SAMPLER_MAX_TRIALS = int(os.environ.get("SAMPLER_MAX_TRIALS", "50000"))  # 기각 표본 시도 상한 → 넘으면 가중 추출
+
+# N인 로비(10명 초과): 10명 출전 + 벤치, 탐색 시간 예산(초)
+LOBBY_MAX_PLAYERS = int(os.environ.get("LOBBY_MAX_PLAYERS", "20"))
+LOBBY_TIME_BUDGET = float(os.environ.get("LOBBY_TIME_BUDGET", "2.0"))
+LOBBY_POOL_LIMIT = 30         # 이만큼 후보를 모은 뒤 그중에서 3개 추첨
+LOBBY_BENCH_PRIORITY = os.environ.get("LOBBY_BENCH_PRIORITY", "1") != "0"
+LAST_BENCH = {}               # 슬롯(채널) → 지난 판에 벤치였던 이름 → 다음 로비에서 우선 출전
+
+# 검색 서비스(프로세스 풀): 워커 수(0이면 요청 스레드에서 바로 계산), 동시 검색 수, 검색 1건 제한 시간(초)
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", "2"))
+SEARCH_QUEUE_LIMIT = int(os.environ.get("SEARCH_QUEUE_LIMIT", "4"))
+SEARCH_ADMIT_WAIT = float(os.environ.get("SEARCH_ADMIT_WAIT", "5"))   # 슬롯이 빌 때까지 기다리는 최대 시간(초)
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", "20"))
+
+# 슬래시 명령 작업 큐: 워커 수, 대기 한도(넘으면 거절), 끝난 작업 상태 보관 시간(초)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", "8"))
+JOB_KEEP_SEC = float(os.environ.get("JOB_KEEP_SEC", "600"))
+DISCORD_API = "https://discord.com/api/v10"
+
+# 조합 풀 LRU 캐시(같은 10명 + 같은 점수면 재계산 없이 세 모드 모두 재사용)
+MATCH_CACHE_SIZE = int(os.environ.get("MATCH_CACHE_SIZE", "16"))
+MATCH_CACHE = OrderedDict()   # {(이름들, 점수해시): pool}
+MATCH_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+MATCH_CACHE_LOCK = threading.Lock()
+
+# 마지막 추첨(/다시, 웹 다시뽑기용): 슬롯(채널) → 풀 참조 + 이미 보여준 인덱스, 최근 LAST_DRAW_SLOTS개 채널만
+LAST_DRAW = OrderedDict()
+LAST_DRAW_SLOTS = int(os.environ.get("LAST_DRAW_SLOTS", "32"))
+LAST_DRAW_LOCK = threading.Lock()
+
+# 속도 제한(토큰 버킷): 초당 RELAY_RATE건, 최대 RELAY_BURST건까지 몰아서
+RELAY_RATE = float(os.environ.get("RELAY_RATE", "1.0"))
+RELAY_BURST = int(os.environ.get("RELAY_BURST", "1"))
+RELAY_RETRIES = int(os.environ.get("RELAY_RETRIES", "2"))          # GAS 5xx/연결 오류 재시도 횟수(지수 백오프)
+RELAY_RAW = os.environ.get("RELAY_RAW", "auto").strip().lower()    # raw(버튼) 포워딩: "auto"(첫 전송으로 확인) | "1" | "0"
+
+# 투표 저장소: "memory"(프로세스 하나) | "sqlite"(POLL_DB 파일, 여러 WSGI 워커가 공유)
+#  - 웹 폼 투표(/vote)와 슬래시 익명 투표(/투표, /공개가 쓰는 '현재' 투표) 모두 여기에 둔다
+#  - 종료된 투표는 POLL_CLOSED_TTL, 열린 투표도 POLL_TTL이 지나면 지운다
+POLL_STORE = os.environ.get("POLL_STORE", "memory").strip().lower()
+POLL_DB = os.environ.get("POLL_DB", "polls.db")
+POLL_TTL = float(os.environ.get("POLL_TTL", "86400"))
+POLL_CLOSED_TTL = float(os.environ.get("POLL_CLOSED_TTL", "600"))
+POLL_DURATION = float(os.environ.get("POLL_DURATION", "180"))   # 슬래시 투표 자동 공개까지(초)
+RELAY_SLOT = "relay"   # 웹에서 만든 조합(릴레이 채널)의 투표 슬롯. 채널 슬롯이 비어 있으면 여기로
 
 
 # --------------------------------
@@ -85,69 +160,907 @@ def verify_discord_signature(req):
 # --------------------------------
 # Google Sheets
 # --------------------------------
+# 시트 게이트웨이: 인증은 한 번, 토큰 만료 시에만 갱신, 스프레드시트/워크시트 핸들은 캐시.
+# 하나의 클라이언트(=하나의 HTTP 세션)를 재사용하고, 실제 API 호출을 엔드포인트별로 센다.
+SHEETS = {"client": None, "creds": None, "ss": None, "ws": {}}
+SHEETS_LOCK = threading.RLock()
+SHEETS_CALLS = defaultdict(int)       # "GET spreadsheets/values" → 누적 호출 수
+SHEETS_CALL_TIMES = deque()           # 최근 60초 호출 시각(쿼터 확인용)
+
+def _sheets_endpoint(method, url):
+    path = urllib.parse.urlparse(url).path
+    known = [seg.split(":")[0] for seg in path.split("/") if seg.split(":")[0] in ("spreadsheets", "values", "files", "sheets")]
+    action = re.search(r':(append|clear|batch\w+|copyTo)$', path)
+    action = action.group(1) if action else ""
+    return f"{method} {'/'.join(known)}" + (f":{action}" if action else "")
+
+def _count_sheets_call(resp, *args, **kwargs):
+    _note_sheets_call(_sheets_endpoint(resp.request.method, resp.url))
+
+def _note_sheets_call(label):
+    now = time.time()
+    with SHEETS_LOCK:
+        SHEETS_CALLS[label] += 1
+        SHEETS_CALL_TIMES.append(now)
+        while SHEETS_CALL_TIMES and now - SHEETS_CALL_TIMES[0] > 60:
+            SHEETS_CALL_TIMES.popleft()
+        if len(SHEETS_CALL_TIMES) == SHEETS_QUOTA_PER_MIN:
+            print(f"⚠️ 시트 API 분당 {SHEETS_QUOTA_PER_MIN}회 도달", file=sys.stderr)
+
+def _instrument_session(client):
+    session = getattr(client, "session", None) or getattr(getattr(client, "http_client", None), "session", None)
+    if session is None:
+        return
+    session.hooks.setdefault("response", []).append(_count_sheets_call)
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 def gs_client():
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(CREDS_FILE, scope)
-    return gspread.authorize(creds)
+    with SHEETS_LOCK:
+        client, creds = SHEETS["client"], SHEETS["creds"]
+        if client is not None and getattr(creds, "access_token_expired", False):
+            if hasattr(client, "login"):
+                client.login()          # 같은 클라이언트에서 토큰만 갱신 → 캐시된 핸들 유지
+            else:
+                client = None
+        if client is None:
+            scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+            creds = ServiceAccountCredentials.from_json_keyfile_name(CREDS_FILE, scope)
+            client = gspread.authorize(creds)
+            _instrument_session(client)
+            SHEETS.update(client=client, creds=creds, ss=None, ws={})
+        return client
+
+def get_spreadsheet():
+    with SHEETS_LOCK:
+        if STORAGE_BACKEND in FAKE_STORAGES:
+            if SHEETS["ss"] is None:
+                SHEETS["ss"] = FAKE_STORAGES[STORAGE_BACKEND]()
+            return SHEETS["ss"]
+        client = gs_client()
+        if SHEETS["ss"] is None:
+            SHEETS["ss"] = client.open_by_key(SHEET_KEY) if SHEET_KEY else client.open(SHEET_NAME)
+        return SHEETS["ss"]
+
+def get_ws(title):
+    """title=None → sheet1(결과 시트)"""
+    with SHEETS_LOCK:
+        ws = SHEETS["ws"].get(title)
+        if ws is None:
+            ss = get_spreadsheet()
+            ws = SHEETS["ws"][title] = ss.sheet1 if title is None else ss.worksheet(title)
+        return ws
+
+def get_results_ws():
+    return get_ws(None)
+
+def get_or_create_ws(title, header, rows=1000):
+    with SHEETS_LOCK:   # 동시에 두 요청이 들어와도 한 번만 생성
+        try:
+            return get_ws(title)
+        except gspread.WorksheetNotFound:
+            ws = get_spreadsheet().add_worksheet(title=title, rows=rows, cols=len(header))
+            ws.update(f'A1:{gspread.utils.rowcol_to_a1(1, len(header))}', [header])
+            SHEETS["ws"][title] = ws
+            return ws
+
+def get_or_create_pending_ws():
+    return get_or_create_ws(PENDING_WS, ['timestamp', 'link', 'status'])
+
+def sheets_stats():
+    with SHEETS_LOCK:
+        now = time.time()
+        return {"calls": dict(SHEETS_CALLS), "last_minute": sum(1 for t in SHEETS_CALL_TIMES if now - t <= 60),
+                "quota_per_min": SHEETS_QUOTA_PER_MIN, "authorized": SHEETS["client"] is not None,
+                "backend": STORAGE_BACKEND}
 
-def get_results_ws(client):
-    return client.open(SHEET_NAME).sheet1
+# --------------------------------
+# 가짜 저장소(memory / sqlite)
+#  - gspread Spreadsheet/Worksheet 중 이 앱이 쓰는 부분만 같은 모양으로 구현
+#    (sheet1, worksheet, add_worksheet, get_lastUpdateTime / get, get_all_values, append_rows, update, batch_update, clear)
+#  - 점수/결과/pending 코드는 그대로 두고 get_spreadsheet()만 바꿔 끼운다
+#  - 값은 시트처럼 문자열로 저장, 읽을 때 행 끝/표 끝의 빈 칸은 잘라낸다
+# --------------------------------
+def _storage_seed():
+    if not STORAGE_SEED:
+        return {"sheet1": [], SCORES_WS: [["이름", "탑", "정글", "미드", "원딜", "서폿"]]}
+    with open(STORAGE_SEED, encoding="utf-8") as f:
+        return json.load(f)
+
+def _trim_grid(rows):
+    rows = [list(r) for r in rows]
+    for r in rows:
+        while r and r[-1] == "":
+            r.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+class GridWorksheet:
+    """행 읽기/쓰기(_rows, _put, _clear)는 하위 클래스가 맡는다"""
+    def __init__(self, book, title):
+        self.book, self.title = book, title
+
+    def get_all_values(self):
+        self.book.touch("get", self.title)
+        rows = self._rows()
+        width = max((len(r) for r in rows), default=0)
+        return [r + [""] * (width - len(r)) for r in rows]
+
+    def get(self, range_name):
+        self.book.touch("get", self.title)
+        g = gspread.utils.a1_range_to_grid_range(range_name)
+        rows = self._rows()[g.get("startRowIndex", 0):g.get("endRowIndex")]
+        return _trim_grid(r[g.get("startColumnIndex", 0):g.get("endColumnIndex")] for r in rows)
+
+    def append_rows(self, values, value_input_option=None):
+        self.book.touch("append", self.title, write=True)
+        start = len(_trim_grid(self._rows())) + 1
+        self._put({start - 1 + i: [str(v) for v in row] for i, row in enumerate(values)})
+        end = gspread.utils.rowcol_to_a1(start + len(values) - 1, max((len(r) for r in values), default=1))
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:{end}"}}
+
+    def append_row(self, values, value_input_option=None):
+        return self.append_rows([values], value_input_option)
+
+    def update(self, range_name, values=None, **kwargs):
+        self.book.touch("update", self.title, write=True)
+        self._set_block(range_name, values)
+
+    def batch_update(self, data, **kwargs):
+        self.book.touch("batchUpdate", self.title, write=True)
+        for item in data:
+            self._set_block(item["range"], item["values"])
+
+    def clear(self):
+        self.book.touch("clear", self.title, write=True)
+        self._clear()
+
+    def _set_block(self, range_name, values):
+        g = gspread.utils.a1_range_to_grid_range(range_name)
+        r0, c0 = g.get("startRowIndex", 0), g.get("startColumnIndex", 0)
+        rows, changed = self._rows(), {}
+        for i, vals in enumerate(values):
+            row = list(rows[r0 + i]) if r0 + i < len(rows) else []
+            row += [""] * (c0 + len(vals) - len(row))
+            row[c0:c0 + len(vals)] = [str(v) for v in vals]
+            changed[r0 + i] = row
+        self._put(changed)
+
+class MemoryWorksheet(GridWorksheet):
+    def __init__(self, book, title, rows=None):
+        super().__init__(book, title)
+        self.data = [[str(v) for v in r] for r in (rows or [])]
+
+    def _rows(self):
+        with self.book.lock:
+            return [list(r) for r in self.data]
+
+    def _put(self, changed):
+        with self.book.lock:
+            for idx, row in changed.items():
+                self.data += [[] for _ in range(idx + 1 - len(self.data))]
+                self.data[idx] = row
+
+    def _clear(self):
+        with self.book.lock:
+            self.data = []
+
+class SqliteWorksheet(GridWorksheet):
+    def _rows(self):
+        with self.book.lock:
+            conn = self.book.db()
+            try:
+                found = conn.execute("SELECT idx, data FROM cells WHERE sheet=? ORDER BY idx", (self.title,)).fetchall()
+            finally:
+                conn.close()
+        rows = []
+        for idx, data in found:
+            rows += [[] for _ in range(idx - len(rows))]
+            rows.append(json.loads(data))
+        return rows
+
+    def _put(self, changed):
+        with self.book.lock:
+            conn = self.book.db()
+            try:
+                conn.executemany("INSERT OR REPLACE INTO cells VALUES (?,?,?)",
+                                 [(self.title, idx, json.dumps(row, ensure_ascii=False)) for idx, row in changed.items()])
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _clear(self):
+        with self.book.lock:
+            conn = self.book.db()
+            try:
+                conn.execute("DELETE FROM cells WHERE sheet=?", (self.title,))
+                conn.commit()
+            finally:
+                conn.close()
+
+class MemoryBook:
+    sheet_class = MemoryWorksheet
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.revision = 0
+        self.sheets = OrderedDict()
+        self._load(_storage_seed())
+
+    def _load(self, seed):
+        seed = dict(seed)
+        self.add_worksheet("sheet1", rows=seed.pop("sheet1", []))   # 첫 시트 = 결과 시트
+        for title, rows in seed.items():
+            self.add_worksheet(title, rows=rows)
+
+    def touch(self, op, title, write=False):
+        if STORAGE_LATENCY_MS or STORAGE_JITTER_MS:
+            time.sleep((STORAGE_LATENCY_MS + random.uniform(0, STORAGE_JITTER_MS)) / 1000)
+        _note_sheets_call(f"{STORAGE_BACKEND} {op}")
+        if write:
+            with self.lock:
+                self.revision += 1
+
+    @property
+    def sheet1(self):
+        return next(iter(self.sheets.values()))
+
+    def worksheet(self, title):
+        try:
+            return self.sheets[title]
+        except KeyError:
+            raise gspread.WorksheetNotFound(title)
+
+    def add_worksheet(self, title, rows=1000, cols=26):
+        with self.lock:
+            ws = self.sheets[title] = self.sheet_class(self, title, rows if isinstance(rows, list) else None)
+            return ws
+
+    def get_lastUpdateTime(self):
+        self.touch("revision", None)
+        with self.lock:
+            return str(self.revision)
+
+class SqliteBook(MemoryBook):
+    """시트 목록/행/수정 번호를 STORAGE_DB에 둔다. 파일이 이미 있으면 시드는 무시"""
+    sheet_class = SqliteWorksheet
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.sheets = OrderedDict()
+        conn = self.db()
+        try:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sheets (pos INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT UNIQUE);
+                CREATE TABLE IF NOT EXISTS cells (sheet TEXT, idx INTEGER, data TEXT, PRIMARY KEY (sheet, idx));
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);""")
+            titles = [t for t, in conn.execute("SELECT title FROM sheets ORDER BY pos")]
+        finally:
+            conn.close()
+        if titles:
+            for title in titles:
+                self.sheets[title] = SqliteWorksheet(self, title)
+        else:
+            self._load(_storage_seed())
+
+    def db(self):
+        return sqlite3.connect(STORAGE_DB, timeout=10)
 
-def get_or_create_pending_ws(client):
-    ss = client.open(SHEET_NAME)
+    def add_worksheet(self, title, rows=1000, cols=26):
+        with self.lock:
+            conn = self.db()
+            try:
+                conn.execute("INSERT OR IGNORE INTO sheets(title) VALUES (?)", (title,))
+                conn.commit()
+            finally:
+                conn.close()
+            ws = self.sheets[title] = SqliteWorksheet(self, title)
+            if isinstance(rows, list) and rows:
+                ws._put({i: [str(v) for v in r] for i, r in enumerate(rows)})
+            return ws
+
+    @property
+    def revision(self):
+        conn = self.db()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key='revision'").fetchone()
+            return row[0] if row else 0
+        finally:
+            conn.close()
+
+    @revision.setter
+    def revision(self, value):
+        conn = self.db()
+        try:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('revision', ?)", (value,))
+            conn.commit()
+        finally:
+            conn.close()
+
+FAKE_STORAGES = {"memory": MemoryBook, "sqlite": SqliteBook}
+
+# --------------------------------
+# 시트 쓰기 배치
+#  - 행 추가는 워크시트별로 모아 append_rows 한 번, 셀 변경(상태 Done 등)은 batch_update 한 번
+#  - 대기 건수가 BATCH_MAX_ROWS 이상이면 즉시, 아니면 BATCH_FLUSH_SEC 뒤 타이머가 flush
+#  - 넣을 때 받은 Future로 그 행의 결과를 받는다(누가 flush하든: 타이머, 다른 요청, 중첩 flush)
+#    성공 → 추가한 행 번호(모르면 None)/True, 실패 → 예외
+#  - 묶음 호출이 실패하면 한 건씩 다시 보내 실패한 행의 Future에만 예외를 넣는다
+# --------------------------------
+WRITE_QUEUE = {"append": defaultdict(list), "cells": defaultdict(list), "timer": None}
+WRITE_QUEUE_LOCK = threading.Lock()
+WRITE_FLUSH_LOCK = threading.Lock()
+
+def _batch_ws(title):
+    return get_or_create_pending_ws() if title == PENDING_WS else get_ws(title)
+
+def _queue_write(kind, title, item):
+    with WRITE_QUEUE_LOCK:
+        WRITE_QUEUE[kind][title].append(item)
+        pending = sum(len(v) for v in WRITE_QUEUE["append"].values()) + sum(len(v) for v in WRITE_QUEUE["cells"].values())
+        if pending < BATCH_MAX_ROWS and WRITE_QUEUE["timer"] is None:
+            WRITE_QUEUE["timer"] = threading.Timer(BATCH_FLUSH_SEC, flush_writes)
+            WRITE_QUEUE["timer"].daemon = True
+            WRITE_QUEUE["timer"].start()
+    if pending >= BATCH_MAX_ROWS:
+        flush_writes()
+
+def queue_append(title, row):
+    """title=None → 결과 시트(sheet1). return: Future → 추가된 행 번호"""
+    fut = Future()
+    _queue_write("append", title, (list(row), fut))
+    return fut
+
+def queue_cell(title, row, col, value):
+    fut = Future()
+    _queue_write("cells", title, ({"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]}, fut))
+    return fut
+
+def wait_writes(futs, timeout=BATCH_WAIT_SEC):
+    """return: 성공하지 못한(실패/시간 초과) Future의 위치 목록"""
+    futures_wait(futs, timeout=timeout)
+    return [i for i, f in enumerate(futs) if not f.done() or f.exception() is not None]
+
+def flush_writes():
+    """이번에 보낸 건의 요약. 각 행의 결과는 queue_*가 돌려준 Future로 받는다
+    return: {"ok": 성공 건수, "failed": [(시트, 행 또는 셀, 오류), ...]}"""
+    failed, outcomes = [], []   # outcomes: (Future, 결과, 예외)
+    with WRITE_FLUSH_LOCK:
+        # 꺼내기도 flush 락 안에서: 꺼낸 뒤 아직 안 보낸 묶음이 있으면 다음 flush(정리 전 flush 등)가 끝날 때까지 기다린다
+        with WRITE_QUEUE_LOCK:
+            appends, cells = WRITE_QUEUE["append"], WRITE_QUEUE["cells"]
+            WRITE_QUEUE.update(append=defaultdict(list), cells=defaultdict(list))
+            if WRITE_QUEUE["timer"] is not None:
+                WRITE_QUEUE["timer"].cancel()
+                WRITE_QUEUE["timer"] = None
+        before = scores_revision_before_write(set(appends) | set(cells)) if appends or cells else None
+        for title, items in appends.items():
+            rows = [row for row, _ in items]
+            try:
+                start = _appended_row(_batch_ws(title).append_rows(rows, value_input_option='USER_ENTERED'))
+                outcomes += [(fut, start + k if start else None, None) for k, (_, fut) in enumerate(items)]
+                continue
+            except Exception as e:
+                print(f"⚠️ append_rows 실패({title}), 한 건씩 재시도:", e, file=sys.stderr)
+            for row, fut in items:
+                try:
+                    resp = _batch_ws(title).append_row(row, value_input_option='USER_ENTERED')
+                    outcomes.append((fut, _appended_row(resp), None))
+                except Exception as e:
+                    failed.append((title, row, str(e)))
+                    outcomes.append((fut, None, e))
+        for title, items in cells.items():
+            updates = [upd for upd, _ in items]
+            try:
+                _batch_ws(title).batch_update(updates)
+                outcomes += [(fut, True, None) for _, fut in items]
+                continue
+            except Exception as e:
+                print(f"⚠️ batch_update 실패({title}), 한 건씩 재시도:", e, file=sys.stderr)
+            for upd, fut in items:
+                try:
+                    _batch_ws(title).batch_update([upd])
+                    outcomes.append((fut, True, None))
+                except Exception as e:
+                    failed.append((title, upd, str(e)))
+                    outcomes.append((fut, None, e))
+        scores_revision_after_write(before)
+    for title, item, err in failed:
+        print(f"⚠️ 시트 쓰기 실패({title}): {item} → {err}", file=sys.stderr)
+    for fut, result, err in outcomes:   # 락 밖에서 완료(Future 콜백이 다른 락을 잡아도 교착 없음)
+        if err is not None:
+            fut.set_exception(err)
+        else:
+            fut.set_result(result)
+    return {"ok": len(outcomes) - len(failed), "failed": failed}
+
+def _appended_row(resp):
+    """append 응답의 updatedRange("'pending'!A12:C13")에서 시작 행 번호"""
     try:
-        ws = ss.worksheet(PENDING_WS)
-    except gspread.WorksheetNotFound:
-        ws = ss.add_worksheet(title=PENDING_WS, rows=1000, cols=3)
-        ws.update('A1:C1', [['timestamp', 'link', 'status']])
-    return ws
+        m = re.search(r'![A-Z]+(\d+)', resp["updates"]["updatedRange"])
+        return int(m.group(1))
+    except Exception:
+        return None
+
+atexit.register(flush_writes)
+
+# --------------------------------
+# 미기록 조합 인덱스
+#  - pending 시트를 한 번만 읽어 link → 미해결 행, 미해결 목록을 메모리에 두고 쓰기와 함께 갱신
+#  - 조회/해결은 시트를 다시 읽지 않는다(해결: O(1), 미해결 목록: O(미해결))
+#  - Done 표시 직전에 그 행의 링크를 다시 읽어 확인한다(다른 프로세스가 정리해 행이 밀렸으면 링크로 다시 찾음)
+#  - Done 행이 PENDING_COMPACT_AT 이상 쌓이면 pending_archive 시트로 옮기고 pending을 앞에서부터 다시 쓴다
+# --------------------------------
+PENDING_INDEX = {"loaded_at": 0.0, "by_link": defaultdict(list), "unresolved": OrderedDict(), "done": 0,
+                 "compacting": False}
+PENDING_LOCK = threading.RLock()
+PENDING_SEQ = itertools.count()
+
+def _pending_entry(link, row):
+    entry = {"key": next(PENDING_SEQ), "link": link, "row": row, "sent": row is not None, "future": None}
+    PENDING_INDEX["unresolved"][entry["key"]] = entry
+    PENDING_INDEX["by_link"][link].append(entry)
+    return entry
+
+def _pending_drop(entry):
+    PENDING_INDEX["unresolved"].pop(entry["key"], None)
+    entries = PENDING_INDEX["by_link"].get(entry["link"], [])
+    if entry in entries:
+        entries.remove(entry)
+    if not entries:
+        PENDING_INDEX["by_link"].pop(entry["link"], None)
+
+def _pending_reload(rows):
+    """rows: pending 시트 2행부터의 [link, status] 목록"""
+    PENDING_INDEX.update(by_link=defaultdict(list), unresolved=OrderedDict(), done=0, loaded_at=time.time())
+    for i, row in enumerate(rows, start=2):
+        link   = row[0] if len(row) > 0 else ""
+        status = row[1] if len(row) > 1 else ""
+        if status == "Done":
+            PENDING_INDEX["done"] += 1
+        elif link and status:
+            _pending_entry(link, i)
+
+def _pending_index():
+    with PENDING_LOCK:
+        stale = time.time() - PENDING_INDEX["loaded_at"] > PENDING_RELOAD_SEC
+        unsent = any(not e["sent"] for e in PENDING_INDEX["unresolved"].values())
+        if stale and not unsent:
+            _pending_reload(get_or_create_pending_ws().get("B2:C"))   # 링크/상태 두 열만
+        return PENDING_INDEX
 
 def pending_add(link):
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     try:
-        client = gs_client()
-        ws = get_or_create_pending_ws(client)
-        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ws.append_row([ts, link, "No"], value_input_option='USER_ENTERED')
+        with PENDING_LOCK:
+            _pending_index()
+            entry = _pending_entry(link, None)
+            entry["future"] = queue_append(PENDING_WS, [ts, link, "No"])
+            entry["future"].add_done_callback(lambda f: _pending_placed(entry, f))
     except Exception as e:
         print("⚠️ pending_add 실패:", e, file=sys.stderr)
 
-def pending_mark_done_by_link(link):
+def _pending_placed(entry, fut):
+    with PENDING_LOCK:
+        entry["sent"] = True
+        if fut.exception() is not None:   # 시트에 안 들어감 → 인덱스에서도 뺀다
+            _pending_drop(entry)
+            return
+        entry["row"] = fut.result()
+        if entry["row"] is None:   # 응답에서 행 번호를 못 얻음 → 다음 조회 때 다시 읽는다
+            PENDING_INDEX["loaded_at"] = 0.0
+
+def _pending_locate(entry):
+    """entry의 현재 행 번호. 기억한 행의 링크가 다르면(다른 프로세스의 정리 등) 링크로 다시 찾는다"""
+    ws = get_or_create_pending_ws()
+    row = entry["row"]
+    if row:
+        got = (ws.get(f"B{row}:C{row}") or [[]])[0]
+        if got[:1] == [entry["link"]] and got[1:2] != ["Done"]:
+            return row
+    rows = ws.get("B2:C")
+    with PENDING_LOCK:
+        if not any(not e["sent"] for e in PENDING_INDEX["unresolved"].values()):
+            _pending_reload(rows)   # 행 번호가 밀렸으니 인덱스도 새로 만든다
+    for i, r in enumerate(rows, start=2):
+        if r[:1] == [entry["link"]] and r[1:2] != ["Done"]:
+            return i
+    return None
+
+def pending_mark_done_by_link(link, flush=True):
     try:
-        client = gs_client()
-        ws = get_or_create_pending_ws(client)
-        rows = ws.get_all_values()
-        for i in range(2, len(rows)+1):
-            row = rows[i-1]
-            row_link = row[1] if len(row) > 1 else ""
-            status   = row[2] if len(row) > 2 else ""
-            if row_link == link and status != "Done":
-                ws.update_cell(i, 3, "Done")
-                return True
+        with PENDING_LOCK:
+            entries = _pending_index()["by_link"].get(link)
+            if not entries:
+                return False
+            entry = entries[0]
+        if not entry["sent"]:   # 아직 시트에 안 들어간 행 → 먼저 보내서 행 번호를 받는다
+            flush_writes()
+            if wait_writes([entry["future"]]):
+                return False
+        with PENDING_LOCK:   # 찾기~Done 넣기 사이에 정리(compact_pending)가 행을 옮기지 못하게
+            row = _pending_locate(entry)
+            if row is None:   # 시트에서 이미 빠졌거나 Done → 인덱스만 정리
+                for e in list(PENDING_INDEX["by_link"].get(link, [])):
+                    _pending_drop(e)
+                return False
+            done_fut = queue_cell(PENDING_WS, row, 3, "Done")
+            entries = PENDING_INDEX["by_link"].get(link, [])
+            _pending_drop(next((e for e in entries if e["row"] == row), entry))
+            PENDING_INDEX["done"] += 1
+            compact = PENDING_INDEX["done"] >= PENDING_COMPACT_AT and not PENDING_INDEX["compacting"]
+            if compact:
+                PENDING_INDEX["compacting"] = True
+        ok = True
+        if flush:
+            flush_writes()
+            ok = not wait_writes([done_fut])
+        if compact:
+            threading.Thread(target=compact_pending, daemon=True).start()
+        return ok
     except Exception as e:
         print("⚠️ pending_mark_done_by_link 실패:", e, file=sys.stderr)
     return False
 
 def pending_fetch_unrecorded():
-    links = []
     try:
-        client = gs_client()
-        ws = get_or_create_pending_ws(client)
-        rows = ws.get_all_values()
-        for r in rows[1:]:
-            if len(r) >= 3 and r[2] != "Done" and r[1]:
-                links.append(r[1])
+        with PENDING_LOCK:
+            return [e["link"] for e in _pending_index()["unresolved"].values()]
     except Exception as e:
         print("⚠️ pending_fetch_unrecorded 실패:", e, file=sys.stderr)
-    return links
+        return []
 
-def load_scores_map():
+def compact_pending():
+    """Done 행을 보관 시트로 옮기고 pending에는 헤더 + 미해결 행만 남긴다. return: 옮긴 행 수"""
     try:
-        client = gs_client()
-        ws = client.open(SHEET_NAME).worksheet(SCORES_WS)
-        rows = ws.get_all_values()
+        with PENDING_LOCK:   # 정리 중에는 pending_add가 기다린다(행 번호가 바뀌므로)
+            flush_writes()   # 대기 중인 추가/Done 표시를 먼저 반영
+            ws = get_or_create_pending_ws()
+            rows = ws.get_all_values()
+            header, body = (rows[:1] or [['timestamp', 'link', 'status']]), rows[1:]
+            done = [r for r in body if len(r) >= 3 and r[2] == "Done"]
+            keep = [r for r in body if any(r) and not (len(r) >= 3 and r[2] == "Done")]
+            if done:
+                # 보관 → 앞에서부터 덮어쓰기 → 남은 꼬리 비우기 순서: 어느 단계에서 실패해도 미해결 행은 남는다
+                archive = get_or_create_ws(PENDING_ARCHIVE_WS, header[0])
+                archive.append_rows(done, value_input_option='USER_ENTERED')
+                ws.update(f'A1:C{1 + len(keep)}', header + keep)
+                if len(rows) > 1 + len(keep):
+                    ws.update(f'A{2 + len(keep)}:C{len(rows)}', [["", "", ""]] * (len(rows) - 1 - len(keep)))
+            _pending_reload([r[1:3] for r in keep])
+            return len(done)
     except Exception as e:
-        print("⚠️ load_scores_map 실패:", e, file=sys.stderr)
+        print("⚠️ compact_pending 실패:", e, file=sys.stderr)
+        return 0
+    finally:
+        PENDING_INDEX["compacting"] = False
+
+def save_results(rows, link):
+    """결과 행 추가 → 모두 들어간 것이 확인되면 미기록 해제. return: 실패한(또는 확인 못 한) 결과 행 목록"""
+    futs = [queue_append(None, row) for row in rows]
+    flush_writes()
+    failed = [rows[i] for i in wait_writes(futs)]
+    if not failed:
+        pending_mark_done_by_link(link)
+    return failed
+
+# --------------------------------
+# 결과 쓰기 저널 (write-behind)
+#  - 결과는 먼저 로컬 SQLite에 기록하고 바로 응답, 백그라운드 스레드가 시트로 재생
+#  - key가 같은 기록은 한 번만 들어간다(버튼 연타/재전송 → 1RD/2RD 중복 방지)
+#  - 실패하면 남은 행만 다시 시도, 간격은 2^시도 초(최대 JOURNAL_RETRY_MAX)
+#  - 재생 전에 항목을 DB에서 점유(next_try를 JOURNAL_LEASE_SEC 뒤로, owner 기록)한 쪽만 보낸다
+#    → 워커(프로세스)가 여럿이어도 같은 항목을 동시에 보내지 않는다
+# --------------------------------
+JOURNAL_LOCK = threading.Lock()
+JOURNAL_WAKE = threading.Event()
+JOURNAL_STATE = {"thread": None, "ready": False, "owner": f"{os.getpid()}:{uuid.uuid4().hex[:8]}"}
+
+def _journal_db():
+    conn = sqlite3.connect(JOURNAL_DB, timeout=10)
+    if not JOURNAL_STATE["ready"]:
+        conn.execute("""CREATE TABLE IF NOT EXISTS journal (
+            key TEXT PRIMARY KEY, link TEXT, rows TEXT, created_at REAL,
+            attempts INTEGER DEFAULT 0, next_try REAL DEFAULT 0, done_at REAL, last_error TEXT, owner TEXT)""")
+        try:
+            conn.execute("ALTER TABLE journal ADD COLUMN owner TEXT")   # 예전 저널 파일
+        except sqlite3.OperationalError:
+            pass
+        conn.commit()
+        JOURNAL_STATE["ready"] = True
+    return conn
+
+def journal_key(*parts):
+    return hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+def journal_results(key, rows, link):
+    """return: True=새로 접수, False=이미 접수된 key"""
+    with JOURNAL_LOCK:
+        conn = _journal_db()
+        try:
+            cur = conn.execute("INSERT OR IGNORE INTO journal(key, link, rows, created_at) VALUES (?,?,?,?)",
+                               (key, link, json.dumps(rows, ensure_ascii=False), time.time()))
+            conn.commit()
+            added = cur.rowcount == 1
+        finally:
+            conn.close()
+    if added:
+        _journal_start()
+        JOURNAL_WAKE.set()
+    return added
+
+def _journal_due():
+    with JOURNAL_LOCK:
+        conn = _journal_db()
+        try:
+            return [k for k, in conn.execute("SELECT key FROM journal WHERE done_at IS NULL AND next_try <= ? "
+                                             "ORDER BY created_at", (time.time(),))]
+        finally:
+            conn.close()
+
+def _journal_claim(key):
+    """다른 워커가 아직 안 잡은 항목이면 점유하고 (link, rows, attempts), 아니면 None"""
+    now, owner = time.time(), JOURNAL_STATE["owner"]
+    with JOURNAL_LOCK:
+        conn = _journal_db()
+        try:
+            cur = conn.execute("UPDATE journal SET next_try=?, owner=? WHERE key=? AND done_at IS NULL AND next_try<=?",
+                               (now + JOURNAL_LEASE_SEC, owner, key, now))
+            conn.commit()
+            if cur.rowcount != 1:
+                return None
+            return conn.execute("SELECT link, rows, attempts FROM journal WHERE key=?", (key,)).fetchone()
+        finally:
+            conn.close()
+
+def _journal_mark(key, rows_left, attempts, err=None):
+    """점유한 워커만 결과를 남긴다(점유 시간이 지나 다른 워커가 가져갔으면 무시)"""
+    owner = JOURNAL_STATE["owner"]
+    with JOURNAL_LOCK:
+        conn = _journal_db()
+        try:
+            if not rows_left:
+                conn.execute("UPDATE journal SET done_at=?, rows='[]', last_error=NULL, owner=NULL WHERE key=? AND owner=?",
+                             (time.time(), key, owner))
+            else:
+                delay = min(2 ** attempts, JOURNAL_RETRY_MAX)
+                conn.execute("UPDATE journal SET rows=?, attempts=?, next_try=?, last_error=?, owner=NULL "
+                             "WHERE key=? AND owner=?",
+                             (json.dumps(rows_left, ensure_ascii=False), attempts, time.time() + delay, err, key, owner))
+            conn.commit()
+        finally:
+            conn.close()
+
+def journal_replay():
+    """밀린 항목을 시트로 보낸다(점유에 성공한 것만). return: 완료 건수"""
+    done = 0
+    for key in _journal_due():
+        claimed = _journal_claim(key)
+        if not claimed:
+            continue   # 다른 워커가 보내는 중이거나 이미 끝남
+        link, rows_json, attempts = claimed
+        rows = json.loads(rows_json)
+        try:
+            left, err = save_results(rows, link), "일부 행 저장 실패"
+        except Exception as e:
+            left, err = rows, str(e)
+        if left:
+            print(f"⚠️ 저널 재생 실패({key[:8]}, {attempts + 1}회):", err, file=sys.stderr)
+        else:
+            done += 1
+        _journal_mark(key, left, attempts + 1, err)
+    if done:
+        mirror_mark_stale()   # 새 결과 행 → 다음 기록 조회 때 증분 동기화
+    return done
+
+def _journal_next_wait():
+    with JOURNAL_LOCK:
+        conn = _journal_db()
+        try:
+            nxt = conn.execute("SELECT MIN(next_try) FROM journal WHERE done_at IS NULL").fetchone()[0]
+        finally:
+            conn.close()
+    return None if nxt is None else max(0.0, nxt - time.time())
+
+def _journal_loop():
+    while True:
+        try:
+            journal_replay()
+            wait_sec = _journal_next_wait()
+        except Exception as e:
+            print("⚠️ 저널 처리 오류:", e, file=sys.stderr)
+            wait_sec = 5.0
+        JOURNAL_WAKE.wait(wait_sec)
+        JOURNAL_WAKE.clear()
+
+def _journal_start():
+    with JOURNAL_LOCK:
+        if JOURNAL_STATE["thread"] is None:
+            JOURNAL_STATE["thread"] = threading.Thread(target=_journal_loop, daemon=True)
+            JOURNAL_STATE["thread"].start()
+
+@app.before_request
+def _journal_resume():
+    """재시작 전에 남은 항목이 있으면 첫 요청 때 재생 스레드를 띄운다(워커마다 뜨지만 항목은 점유한 쪽만 보낸다)"""
+    if JOURNAL_STATE["thread"] is None and os.path.exists(JOURNAL_DB):
+        _journal_start()
+
+def journal_stats():
+    try:
+        with JOURNAL_LOCK:
+            conn = _journal_db()
+            try:
+                done, waiting, retrying = conn.execute(
+                    "SELECT COUNT(done_at), SUM(done_at IS NULL), SUM(done_at IS NULL AND attempts > 0) FROM journal").fetchone()
+                err = conn.execute("SELECT last_error FROM journal WHERE done_at IS NULL AND last_error IS NOT NULL "
+                                   "ORDER BY created_at DESC LIMIT 1").fetchone()
+            finally:
+                conn.close()
+        return {"done": done, "waiting": waiting or 0, "retrying": retrying or 0, "last_error": err[0] if err else None}
+    except Exception as e:
+        return {"error": str(e)}
+
+# --------------------------------
+# 로컬 미러 (SQLite)
+#  - 기록장: 시트에서 받을 때마다 통째로 저장(점수는 제자리 수정이라 행 추가만 볼 수 없음)
+#  - 결과 시트: 추가만 되므로 마지막으로 받은 행 번호(watermark) 다음부터만 받는다
+#  - 구글이 안 될 때도 점수/기록 조회는 미러로 계속 동작
+# --------------------------------
+MIRROR_LOCK = threading.Lock()        # DB 접근
+MIRROR_SYNC_LOCK = threading.Lock()   # 결과 시트 동기화는 한 번에 하나
+MIRROR_STATE = {"ready": False, "syncing": False}
+LANE_COLUMNS = ("top", "jungle", "mid", "adc", "sup")
+
+def _mirror_db():
+    conn = sqlite3.connect(MIRROR_DB, timeout=10)
+    if not MIRROR_STATE["ready"]:
+        conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS scores (name TEXT PRIMARY KEY, {", ".join(c + " INTEGER" for c in LANE_COLUMNS)});
+            CREATE TABLE IF NOT EXISTS results (row INTEGER PRIMARY KEY, date TEXT, round TEXT, winners TEXT, losers TEXT);
+            CREATE TABLE IF NOT EXISTS sync (sheet TEXT PRIMARY KEY, watermark INTEGER, synced_at REAL);""")
+        conn.commit()
+        MIRROR_STATE["ready"] = True
+    return conn
+
+def _mirror_sync_row(conn, sheet):
+    row = conn.execute("SELECT watermark, synced_at FROM sync WHERE sheet=?", (sheet,)).fetchone()
+    return row or (0, 0.0)
+
+def mirror_save_scores(data):
+    with MIRROR_LOCK:
+        conn = _mirror_db()
+        try:
+            conn.execute("DELETE FROM scores")
+            conn.executemany(f"INSERT INTO scores VALUES (?{',?' * len(LANE_COLUMNS)})",
+                             [(name, *scores) for name, scores in data.items()])
+            conn.execute("INSERT OR REPLACE INTO sync VALUES ('scores', ?, ?)", (len(data) + 1, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+def mirror_scores():
+    try:
+        with MIRROR_LOCK:
+            conn = _mirror_db()
+            try:
+                return {r[0]: list(r[1:]) for r in conn.execute("SELECT * FROM scores")}
+            finally:
+                conn.close()
+    except Exception as e:
+        print("⚠️ 미러 점수 읽기 실패:", e, file=sys.stderr)
         return {}
+
+def mirror_sync_results(full=False):
+    """결과 시트에서 watermark 다음 행만 받아 미러에 추가. return: 추가된 경기 수"""
+    with MIRROR_SYNC_LOCK:
+        with MIRROR_LOCK:
+            conn = _mirror_db()
+            try:
+                watermark = 0 if full else _mirror_sync_row(conn, "results")[0]
+            finally:
+                conn.close()
+        rows = get_results_ws().get(f"A{watermark + 1}:L")   # [날짜, 1RD/2RD, 승리팀 5명, 패배팀 5명]
+        games = [(watermark + 1 + i, r[0], r[1], json.dumps(r[2:7], ensure_ascii=False), json.dumps(r[7:12], ensure_ascii=False))
+                 for i, r in enumerate(rows) if len(r) >= 12 and r[1] in ("1RD", "2RD")]
+        with MIRROR_LOCK:
+            conn = _mirror_db()
+            try:
+                if full:
+                    conn.execute("DELETE FROM results")
+                conn.executemany("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?)", games)
+                conn.execute("INSERT OR REPLACE INTO sync VALUES ('results', ?, ?)", (watermark + len(rows), time.time()))
+                conn.commit()
+            finally:
+                conn.close()
+        return len(games)
+
+def _mirror_sync_bg():
+    try:
+        mirror_sync_results()
+    except Exception as e:
+        print("⚠️ 결과 미러 동기화 실패:", e, file=sys.stderr)
+    finally:
+        MIRROR_STATE["syncing"] = False
+
+def mirror_refresh_results():
+    """동기화가 MIRROR_SYNC_SEC보다 오래됐으면 백그라운드로 증분 동기화(조회는 기다리지 않음)"""
+    with MIRROR_LOCK:
+        conn = _mirror_db()
+        try:
+            synced_at = _mirror_sync_row(conn, "results")[1]
+        finally:
+            conn.close()
+        if time.time() - synced_at < MIRROR_SYNC_SEC or MIRROR_STATE["syncing"]:
+            return False
+        MIRROR_STATE["syncing"] = True
+    threading.Thread(target=_mirror_sync_bg, daemon=True).start()
+    return True
+
+def mirror_mark_stale():
+    try:
+        with MIRROR_LOCK:
+            conn = _mirror_db()
+            try:
+                conn.execute("UPDATE sync SET synced_at=0 WHERE sheet='results'")
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        print("⚠️ 미러 상태 갱신 실패:", e, file=sys.stderr)
+
+def player_history(name, limit=20):
+    """미러에서 한 사람의 전적. return: {"wins","losses","recent":[(날짜, 라운드, 승패, 같은팀, 상대팀)]}"""
+    pattern = "%" + json.dumps(name, ensure_ascii=False) + "%"
+    with MIRROR_LOCK:
+        conn = _mirror_db()
+        try:
+            rows = conn.execute("SELECT date, round, winners, losers FROM results WHERE winners LIKE ? OR losers LIKE ? "
+                                "ORDER BY row DESC", (pattern, pattern)).fetchall()
+        finally:
+            conn.close()
+    wins = losses = 0
+    recent = []
+    for date, rnd, winners, losers in rows:
+        winners, losers = json.loads(winners), json.loads(losers)
+        won = name in winners
+        if not won and name not in losers:
+            continue   # LIKE가 이름 일부로 걸린 경우
+        wins += won; losses += not won
+        if len(recent) < limit:
+            recent.append((date, rnd, "승" if won else "패", winners if won else losers, losers if won else winners))
+    return {"wins": wins, "losses": losses, "recent": recent}
+
+def mirror_stats():
+    try:
+        with MIRROR_LOCK:
+            conn = _mirror_db()
+            try:
+                players = conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+                games = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+                watermark, synced_at = _mirror_sync_row(conn, "results")
+            finally:
+                conn.close()
+        return {"players": players, "games": games, "watermark": watermark,
+                "results_age": round(time.time() - synced_at, 1) if synced_at else None}
+    except Exception as e:
+        return {"error": str(e)}
+
+# --------------------------------
+# 점수표 캐시 (TTL + stale-while-revalidate + 수정시각 확인)
+#  - TTL 안: 메모리 값 그대로
+#  - TTL 지남: 옛 값을 바로 주고 백그라운드에서 재검증
+#  - MAX_STALE 지남/처음: 그 자리에서 재검증
+#  - 재검증은 스프레드시트 수정시각(lastUpdateTime)만 먼저 보고, 바뀌었을 때만 기록장을 다시 받는다
+#    · 앱 자신의 쓰기(결과/pending)로 바뀐 수정시각은 flush 앞뒤로 확인해 캐시에 반영 → 기록장을 다시 받지 않는다
+#  - 받은 값은 미러에도 저장, 처음 읽을 때/시트 장애 때는 미러 값을 쓴다
+#  - 재검증이 실패하면 옛 값(없으면 미러)을 계속 주고, 다음 시도는 SCORES_TTL × 2^연속실패 초 뒤(최대 MAX_STALE)
+# --------------------------------
+SCORES_CACHE = {"data": None, "fetched_at": 0.0, "revision": None, "version": 0, "refreshing": False,
+                "fails": 0, "retry_at": 0.0}
+SCORES_LOCK = threading.Lock()
+SCORES_STATS = {"hits": 0, "stale": 0, "revalidated": 0, "downloads": 0, "errors": 0, "mirror": 0}
+
+def parse_scores_rows(rows):
     score_map = {}
     if not rows:
         return score_map
@@ -168,6 +1081,124 @@ def load_scores_map():
         score_map[name] = scores
     return score_map
 
+def _spreadsheet_revision(ss):
+    try:
+        if hasattr(ss, "get_lastUpdateTime"):
+            return ss.get_lastUpdateTime()   # 캐시된 핸들이라도 Drive에서 새로 확인
+        return ss.lastUpdateTime
+    except Exception:
+        return None   # 수정시각을 못 얻으면 매번 새로 받는다
+
+def scores_revision_before_write(titles):
+    """기록장이 아닌 시트에 쓰기 직전: 시트 수정시각이 캐시와 같으면 그 값(쓰기 뒤 비교용), 아니면 None"""
+    with SCORES_LOCK:
+        cached = SCORES_CACHE["revision"]
+    if cached is None or SCORES_WS in titles:
+        return None
+    try:
+        return cached if _spreadsheet_revision(get_spreadsheet()) == cached else None
+    except Exception:
+        return None
+
+def scores_revision_after_write(before):
+    """쓰기 전 수정시각이 캐시와 같았다면 쓰기 뒤 바뀐 수정시각은 앱의 쓰기 → 캐시 수정시각만 옮긴다"""
+    if before is None:
+        return
+    try:
+        after = _spreadsheet_revision(get_spreadsheet())
+    except Exception:
+        return
+    with SCORES_LOCK:
+        if after is not None and SCORES_CACHE["revision"] == before:
+            SCORES_CACHE["revision"] = after
+
+def refresh_scores(force=False):
+    """시트에서 재검증. 수정시각이 같으면 다운로드 없이 fetched_at만 갱신"""
+    try:
+        ss = get_spreadsheet()
+        revision = _spreadsheet_revision(ss)
+        with SCORES_LOCK:
+            unchanged = (not force and revision is not None and SCORES_CACHE["data"] is not None
+                         and revision == SCORES_CACHE["revision"])
+            if unchanged:
+                SCORES_CACHE.update(fetched_at=time.time(), fails=0, retry_at=0.0)
+                SCORES_STATS["revalidated"] += 1
+                return SCORES_CACHE["data"]
+        data = parse_scores_rows(get_ws(SCORES_WS).get_all_values())
+    except Exception as e:
+        print("⚠️ load_scores_map 실패:", e, file=sys.stderr)
+        data = None if SCORES_CACHE["data"] else mirror_scores()
+        with SCORES_LOCK:
+            SCORES_STATS["errors"] += 1
+            SCORES_CACHE["fails"] += 1
+            backoff = min(SCORES_TTL * 2 ** (SCORES_CACHE["fails"] - 1), SCORES_MAX_STALE)
+            SCORES_CACHE["retry_at"] = time.time() + backoff
+            if data and not SCORES_CACHE["data"]:
+                SCORES_CACHE.update(data=data, version=SCORES_CACHE["version"] + 1)
+                SCORES_STATS["mirror"] += 1
+            if SCORES_CACHE["data"]:   # 옛 값으로 계속 응답(요청이 장애 난 API를 기다리지 않게)
+                SCORES_CACHE["fetched_at"] = time.time() - SCORES_TTL
+            return SCORES_CACHE["data"] or {}
+    try:
+        mirror_save_scores(data)
+    except Exception as e:
+        print("⚠️ 미러 점수 저장 실패:", e, file=sys.stderr)
+    with SCORES_LOCK:
+        SCORES_STATS["downloads"] += 1
+        if data != SCORES_CACHE["data"]:
+            SCORES_CACHE["version"] += 1
+        SCORES_CACHE.update(data=data, fetched_at=time.time(), revision=revision, fails=0, retry_at=0.0)
+        return data
+
+def _refresh_scores_bg():
+    try:
+        refresh_scores()
+    finally:
+        with SCORES_LOCK:
+            SCORES_CACHE["refreshing"] = False
+
+def _seed_scores_from_mirror():
+    """프로세스 시작 직후: 시트를 기다리지 않고 미러 값을 '오래된 값'으로 올려 둔다"""
+    data = mirror_scores()
+    with SCORES_LOCK:
+        if data and SCORES_CACHE["data"] is None:
+            SCORES_CACHE.update(data=data, fetched_at=time.time() - SCORES_TTL, version=SCORES_CACHE["version"] + 1)
+            SCORES_STATS["mirror"] += 1
+
+def load_scores_map():
+    if SCORES_CACHE["data"] is None:
+        _seed_scores_from_mirror()
+    with SCORES_LOCK:
+        data, age = SCORES_CACHE["data"], time.time() - SCORES_CACHE["fetched_at"]
+        if data is not None and age < SCORES_TTL:
+            SCORES_STATS["hits"] += 1
+            return data
+        backing_off = time.time() < SCORES_CACHE["retry_at"]
+        if data is not None and (age < SCORES_MAX_STALE or backing_off):
+            SCORES_STATS["stale"] += 1
+            if not SCORES_CACHE["refreshing"] and not backing_off:
+                SCORES_CACHE["refreshing"] = True
+                threading.Thread(target=_refresh_scores_bg, daemon=True).start()
+            return data
+        if backing_off:   # 옛 값도 없고 재시도 전 → 미러
+            return mirror_scores()
+    return refresh_scores()
+
+def invalidate_scores():
+    """점수 수정 직후 호출: 다음 읽기에서 수정시각과 상관없이 새로 받는다"""
+    with SCORES_LOCK:
+        SCORES_CACHE.update(fetched_at=0.0, revision=None, retry_at=0.0)
+
+def scores_version():
+    with SCORES_LOCK:
+        return SCORES_CACHE["version"]
+
+def scores_cache_stats():
+    with SCORES_LOCK:
+        age = time.time() - SCORES_CACHE["fetched_at"] if SCORES_CACHE["data"] is not None else None
+        return dict(SCORES_STATS, version=SCORES_CACHE["version"], players=len(SCORES_CACHE["data"] or {}),
+                    age=round(age, 1) if age is not None else None, ttl=SCORES_TTL)
+
 
 # --------------------------------
 # 팀 배치/조합 계산
@@ -209,92 +1240,1192 @@ def valid_assignments(team, king_name=None, king_position=None):
                 assignment = sorted(assignment, key=lambda x: positions.index(x[0]))
                 results.append((total_score, assignment))
     else:
-        for perm in itertools.permutations(range(5)):
-            total_score = 0
-            assignment = []
-            valid = True
-            for player, pos in zip(team, perm):
-                name, scores = player
-                score = scores[pos]
-                if score <= 0:
-                    valid = False
-                    break
-                assignment.append((positions[pos], name, score))
-                total_score += score
-            if valid:
-                assignment = sorted(assignment, key=lambda x: positions.index(x[0]))
-                results.append((total_score, assignment))
+        for perm in valid_lane_perms(team):
+            assignment = [(positions[pos], name, scores[pos]) for (name, scores), pos in zip(team, perm)]
+            total_score = sum(x[2] for x in assignment)
+            assignment = sorted(assignment, key=lambda x: positions.index(x[0]))
+            results.append((total_score, assignment))
     return results
 
+def valid_lane_perms(team):
+    """
+    선수별로 가능한 포지션(score > 0)만 따라 내려가는 순열 백트래킹.
+    itertools.permutations(range(5))에서 불가 배치를 뺀 것과 같은 순서로 나온다.
+    """
+    allowed = [[pos for pos in range(5) if scores[pos] > 0] for _, scores in team]
+    perm, used = [], [False] * 5
+    def rec(i):
+        if i == len(team):
+            yield tuple(perm); return
+        for pos in allowed[i]:
+            if not used[pos]:
+                used[pos] = True; perm.append(pos)
+                yield from rec(i + 1)
+                perm.pop(); used[pos] = False
+    return rec(0)
+
+
+# --------------------------------
+# 고정/금지/같은 팀/다른 팀 조건
+#  - "두낫=정글"(포지션 고정) "밈밈!=서폿"(포지션 금지) "A+B"(같은 팀) "A/B"(다른 팀)
+#  - 고정/금지는 해당 포지션 점수를 0으로 가려서(score <= 0 = 불가) 순열 생성 단계에서 잘리고,
+#    같은 팀/다른 팀은 분할(5인 부분집합) 생성 단계에서 잘린다 → 결과를 거르는 게 아니라 애초에 안 만든다
+# --------------------------------
+POSITION_ALIASES = {"서포터": "서폿", "서포트": "서폿", "바텀": "원딜", "정글러": "정글",
+                    "top": "탑", "jg": "정글", "jungle": "정글", "mid": "미드", "adc": "원딜", "sup": "서폿"}
+
+def empty_rules():
+    return {"pins": {}, "bans": {}, "same": [], "apart": []}
+
+def parse_rules(text, names):
+    """return: (rules, None) 또는 (None, 오류메시지)"""
+    rules = empty_rules()
+    for tok in re.split(r'[\s,;]+', text or ""):
+        if not tok:
+            continue
+        m = re.fullmatch(r'(.+?)(!=|=)(.+)', tok)
+        if m:
+            name, op, pos = m.group(1), m.group(2), POSITION_ALIASES.get(m.group(3).lower(), m.group(3))
+            if name not in names: return None, f"⚠️ 명단에 없는 이름: {name}"
+            if pos not in positions: return None, f"⚠️ 알 수 없는 포지션: {m.group(3)}"
+            if op == "=": rules["pins"][name] = positions.index(pos)
+            else:         rules["bans"].setdefault(name, set()).add(positions.index(pos))
+            continue
+        m = re.fullmatch(r'(.+?)([+/])(.+)', tok)
+        if m:
+            a, op, b = m.group(1), m.group(2), m.group(3)
+            for name in (a, b):
+                if name not in names: return None, f"⚠️ 명단에 없는 이름: {name}"
+            if a == b: return None, f"⚠️ 같은 이름끼리는 조건을 걸 수 없습니다: {tok}"
+            rules["same" if op == "+" else "apart"].append(tuple(sorted((a, b))))
+            continue
+        return None, f"⚠️ 조건 형식 오류: {tok} (예: 두낫=정글, 밈밈!=서폿, A+B, A/B)"
+    return rules, None
+
+def rule_names(rules):
+    """로비에서 반드시 출전해야 하는 이름(고정 + 같은/다른 팀 조건 대상)"""
+    if not rules:
+        return []
+    names = list(rules["pins"])
+    for a, b in rules["same"] + rules["apart"]:
+        names += [a, b]
+    return list(dict.fromkeys(names))
+
+def rules_key(rules):
+    """캐시 키용: 고정/금지는 가려진 점수 해시에 이미 반영되므로 팀 조건만"""
+    if not rules:
+        return ()
+    return tuple(sorted(set(rules["same"]))), tuple(sorted(set(rules["apart"])))
+
+def apply_lane_rules(players, rules):
+    if not rules:
+        return players
+    out = []
+    for name, scores in players:
+        sc = list(scores[:5])
+        if name in rules["pins"]:
+            lane = rules["pins"][name]
+            sc = [v if i == lane else 0 for i, v in enumerate(sc)]
+        for lane in rules["bans"].get(name, ()):
+            sc[lane] = 0
+        out.append((name, sc))
+    return out
+
+def team_pair_index(players, rules):
+    """이름 조건 → 인덱스별 {같은 팀 상대}, {다른 팀 상대}"""
+    idx = {name: i for i, (name, _) in enumerate(players)}
+    same, apart = defaultdict(set), defaultdict(set)
+    for pairs, out in (((rules or {}).get("same", []), same), ((rules or {}).get("apart", []), apart)):
+        for a, b in pairs:
+            if a in idx and b in idx:
+                out[idx[a]].add(idx[b]); out[idx[b]].add(idx[a])
+    return same, apart
+
+def team_splits(players, rules=None):
+    """
+    0번을 A에 고정한 10명 분할(A쪽 인덱스 5개)을 사전순으로 생성.
+    같은 팀/다른 팀 조건은 자리를 정할 때마다 바로 확인해서 어긋나는 가지는 내려가지 않는다.
+    """
+    n = len(players)
+    same, apart = team_pair_index(players, rules)
+    side = [None] * n
+    side[0] = 0
+    def rec(i, a_cnt):
+        if i == n:
+            if a_cnt == n // 2:
+                yield tuple(j for j in range(n) if side[j] == 0)
+            return
+        for sd in (0, 1):
+            if sd == 0 and a_cnt == n // 2: continue
+            if sd == 1 and i - a_cnt == n // 2: continue
+            if any(side[j] is not None and side[j] != sd for j in same[i]): continue
+            if any(side[j] == sd for j in apart[i]): continue
+            side[i] = sd
+            yield from rec(i + 1, a_cnt + (sd == 0))
+            side[i] = None
+    yield from rec(1, 1)
+
+
+# --------------------------------
+# 조합 탐색 (총점 버킷 조인)
+#  - 각 팀의 배치를 총점별로 묶고 sa == sb, |sa - sb| == 5 버킷끼리만 짝짓는다
+#  - 풀에는 (sa, A배치목록, sb, B배치목록) 버킷 쌍만 두고, 실제 조합은 뽑을 때만 만든다
+#  - A/B 대칭: 0번 선수가 있는 쪽을 기준으로 126개 분할(team_splits)만 계산하고, 뒤집힌 쌍은 참조만 추가
+# --------------------------------
+MODE_TITLES = {"exact": "0점 차이", "five": "5점 차이", "all": "전체 조합"}
+MODE_GAPS = {"exact": (0,), "five": (5,), "all": (0, 5)}
+
+def score_buckets(team):
+    buckets = defaultdict(list)
+    for total, asg in valid_assignments(team):
+        buckets[total].append(asg)
+    return buckets
+
+def subset_buckets(players, idx, memo):
+    """요청 단위 메모: 같은 5인 부분집합의 배치는 한 번만 계산"""
+    bkt = memo.get(idx)
+    if bkt is None:
+        bkt = memo[idx] = score_buckets([players[i] for i in idx])
+    return bkt
+
+def search_match_pool(players, memo=None, rules=None, splits=None):
+    """splits: 계산할 분할 목록(A쪽 인덱스). None이면 조건에 맞는 전체"""
+    if MATCH_BACKEND == "numpy" and np is not None:
+        return search_match_pool_np(players, rules, splits)
+    memo = {} if memo is None else memo
+    exact, five = [], []
+    for ta_idx in (team_splits(players, rules) if splits is None else splits):
+        tb_idx = tuple(i for i in range(10) if i not in ta_idx)
+        bkt_a = subset_buckets(players, ta_idx, memo)
+        bkt_b = subset_buckets(players, tb_idx, memo)
+        for sa, la in bkt_a.items():
+            lb = bkt_b.get(sa)
+            if lb:
+                exact.append((sa, la, sa, lb)); exact.append((sa, lb, sa, la))
+            for sb in (sa - 5, sa + 5):
+                lb = bkt_b.get(sb)
+                if lb:
+                    five.append((sa, la, sb, lb)); five.append((sb, lb, sa, la))
+    return {"exact": exact, "five": five}
+
+
+# --------------------------------
+# 조합 탐색 (NumPy 벡터화 백엔드)
+#  - 10x5 점수 행렬 + 120개 순열 인덱스로 (분할 수 x2)x120 팀 총점을 한 번에 계산(조건 없으면 252x120)
+#  - score <= 0 포지션은 마스크로 제외, 버킷 조인은 정렬 배열 searchsorted
+# --------------------------------
+ALL_PERMS = list(itertools.permutations(range(5)))
+
+class LazyAssignments:
+    """순열 인덱스 배열을 들고 있다가 꺼낼 때만 [(pos, name, score), ...] 배치를 만든다"""
+    __slots__ = ("team", "perm_ids")
+
+    def __init__(self, team, perm_ids):
+        self.team, self.perm_ids = team, perm_ids
+
+    def __len__(self):
+        return len(self.perm_ids)
+
+    def __getitem__(self, i):
+        asg = [None] * 5
+        for (name, scores), pos in zip(self.team, ALL_PERMS[self.perm_ids[i]]):
+            asg[pos] = (positions[pos], name, scores[pos])
+        return asg
+
+def _np_buckets(team, totals, valid):
+    ids = np.flatnonzero(valid)
+    ids = ids[np.argsort(totals[ids], kind="stable")]
+    keys, starts, counts = np.unique(totals[ids], return_index=True, return_counts=True)
+    return keys, [LazyAssignments(team, ids[st:st+c]) for st, c in zip(starts, counts)]
+
+def search_match_pool_np(players, rules=None, splits=None):
+    ta_list = list(team_splits(players, rules) if splits is None else splits)
+    tb_list = [tuple(i for i in range(10) if i not in ta) for ta in ta_list]
+    exact, five = [], []
+    if not ta_list:
+        return {"exact": exact, "five": five}
+    score_mx = np.array([scores[:5] for _, scores in players], dtype=np.int64)   # 10x5
+    splits, perms = np.array(ta_list + tb_list), np.array(ALL_PERMS)           # 252x5, 120x5
+    cell = score_mx[splits[:, None, :], perms[None, :, :]]                      # 252x120x5
+    valid = (cell > 0).all(axis=2)
+    totals = cell.sum(axis=2)
+
+    half = len(ta_list)
+    for k, (ta_idx, tb_idx) in enumerate(zip(ta_list, tb_list)):
+        kb = half + k
+        keys_a, la_list = _np_buckets([players[i] for i in ta_idx], totals[k], valid[k])
+        keys_b, lb_list = _np_buckets([players[i] for i in tb_idx], totals[kb], valid[kb])
+        if not len(keys_a) or not len(keys_b):
+            continue
+        for diff, out in ((0, exact), (-5, five), (5, five)):
+            want = keys_a + diff
+            at = np.searchsorted(keys_b, want)
+            hit = at < len(keys_b)
+            hit[hit] = keys_b[at[hit]] == want[hit]
+            for ia in np.flatnonzero(hit):
+                sa, sb = int(keys_a[ia]), int(want[ia])
+                la, lb = la_list[ia], lb_list[at[ia]]
+                out.append((sa, la, sb, lb)); out.append((sb, lb, sa, la))
+    return {"exact": exact, "five": five}
+
+
+# --------------------------------
+# N인 로비 탐색 (분기 한정)
+#  - 라인별로 A/B 한 명씩 배치하며 내려가고, 남은 라인의 (최대-최소) 점수 폭으로
+#    최종 점수 차를 한정해 목표 차이에 못 미치는 가지는 잘라낸다
+#  - 무작위 순서로 재시작하며 새 조합을 하나씩 찾고, 시간 예산이 끝나면 모은 것만 반환
+# --------------------------------
+class SearchTimeout(Exception):
+    pass
+
+def search_lobby_pool(players, mode="all", must_play=(), time_budget=None, limit=None, rng=random, max_gap=None,
+                      rules=None, first_pick=None):
+    """
+    max_gap을 주면 mode 대신 0~max_gap 차이를 모두 허용하고 "near"에 모아 반환.
+    first_pick: 첫 라인(탑) A쪽 후보 인덱스 제한 — 프로세스별로 탐색 공간을 나눌 때 사용
+    """
+    if max_gap is None:
+        gaps = MODE_GAPS.get(mode, MODE_GAPS["all"])
+    else:
+        gaps = tuple(range(max_gap + 1))
+    max_gap = max(gaps)
+    n = len(players)
+    must = {i for i, (name, _) in enumerate(players) if name in must_play}
+    same, apart = team_pair_index(players, rules)
+    side = {}   # 인덱스 → 0(A)/1(B)
+    deadline = time.monotonic() + (LOBBY_TIME_BUDGET if time_budget is None else time_budget)
+    limit = LOBBY_POOL_LIMIT if limit is None else limit
+    found = {}
+
+    def lane_span(used, lane_from):
+        span = 0
+        for lane in range(lane_from, 5):
+            vals = [players[i][1][lane] for i in range(n) if i not in used and players[i][1][lane] > 0]
+            if len(vals) < 2:
+                return None  # 남은 선수로 이 라인을 채울 수 없음
+            span += max(vals) - min(vals)
+        return span
+
+    def fits(i, sd):
+        return all(side.get(j, sd) == sd for j in same[i]) and all(side.get(j) != sd for j in apart[i])
+
+    def dfs(lane, used, pa, pb, asg_a, asg_b):
+        if time.monotonic() > deadline:
+            raise SearchTimeout()
+        if lane == 5:
+            key = (tuple(asg_a), tuple(asg_b))
+            if abs(pa - pb) in gaps and not (must - used) and key not in found:
+                found[key] = (pa, list(asg_a), pb, list(asg_b))
+                return True
+            return False
+        if len(must - used) > 2 * (5 - lane):
+            return False
+        span = lane_span(used, lane)
+        if span is None or abs(pa - pb) - span > max_gap:
+            return False
+        cand = [i for i in range(n) if i not in used and players[i][1][lane] > 0]
+        rng.shuffle(cand)
+        for ia in cand:
+            if lane == 0 and first_pick is not None and ia not in first_pick:
+                continue
+            if not fits(ia, 0):
+                continue
+            name_a, sc_a = players[ia]
+            side[ia] = 0
+            for ib in cand:
+                if ib == ia or not fits(ib, 1):
+                    continue
+                name_b, sc_b = players[ib]
+                side[ib] = 1
+                used.add(ia); used.add(ib)
+                asg_a.append((positions[lane], name_a, sc_a[lane]))
+                asg_b.append((positions[lane], name_b, sc_b[lane]))
+                ok = dfs(lane + 1, used, pa + sc_a[lane], pb + sc_b[lane], asg_a, asg_b)
+                asg_a.pop(); asg_b.pop()
+                used.discard(ia); used.discard(ib)
+                del side[ib]
+                if ok:
+                    del side[ia]
+                    return True
+            del side[ia]
+        return False
+
+    try:
+        while len(found) < limit and dfs(0, set(), 0, 0, [], []):
+            pass
+    except SearchTimeout:
+        pass
+
+    exact, five, near = [], [], []
+    for sa, aa, sb, bb in found.values():
+        blk = (sa, [aa], sb, [bb])
+        near.append(blk)
+        if sa == sb: exact.append(blk)
+        elif abs(sa - sb) == 5: five.append(blk)
+    return {"exact": exact, "five": five, "near": near}
+
+
+# --------------------------------
+# 검색 서비스 (프로세스 풀)
+#  - 무거운 탐색은 ProcessPoolExecutor에서 돌려 GIL 때문에 다른 요청(/투표 3초 응답 등)이 밀리지 않게 한다
+#  - 동시에 받는 검색 수는 SEARCH_QUEUE_LIMIT 슬롯으로 제한: 자리가 나길 SEARCH_ADMIT_WAIT초 기다리고, 그래도 없으면 거절
+#  - 1건당 SEARCH_TIMEOUT: 청크마다 같은 마감 시각을 넘겨 워커 안의 탐색도 그때 멈춘다(늦게 시작한 청크는 바로 끝남)
+#  - 10명 풀은 요청 스레드에서 바로 계산(결과 블록을 프로세스 사이로 옮기는 비용이 계산보다 크다)
+#  - 로비(11명 이상)는 첫 라인 A 후보를 나눠 워커마다 맡기고, 워커당 상한만큼의 후보만 돌려받아 합친다
+#  - 워커는 forkserver(없으면 spawn)로 띄운다: 스레드가 돌고 있는 웹 프로세스를 fork하지 않는다
+# --------------------------------
+class SearchRejected(Exception):
+    pass
+
+SEARCH_POOL = None
+SEARCH_POOL_LOCK = threading.Lock()
+SEARCH_SLOTS = threading.BoundedSemaphore(max(1, SEARCH_QUEUE_LIMIT))
+
+def search_executor():
+    global SEARCH_POOL, SEARCH_WORKERS
+    with SEARCH_POOL_LOCK:
+        if SEARCH_POOL is None and SEARCH_WORKERS > 0:
+            try:
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                SEARCH_POOL = ProcessPoolExecutor(max_workers=SEARCH_WORKERS, mp_context=ctx)
+            except Exception as e:   # 프로세스 생성이 막힌 환경 → 인라인으로 전환
+                print("⚠️ 검색 프로세스 풀 생성 실패, 인라인 계산:", e, file=sys.stderr)
+                SEARCH_WORKERS = 0
+        return SEARCH_POOL
+
+def _lobby_chunk(players, mode, must, rules, max_gap, part, parts, seed, deadline):
+    """deadline: 벽시계(time.time()) 마감 — 프로세스가 달라도 같은 기준"""
+    left = deadline - time.time()
+    if left <= 0:
+        return {"exact": [], "five": [], "near": []}
+    first = {i for i in range(len(players)) if i % parts == part}
+    return search_lobby_pool(players, mode, must_play=must, rules=rules, max_gap=max_gap, first_pick=first,
+                             time_budget=min(LOBBY_TIME_BUDGET, left), rng=random.Random(seed))
+
+def run_search_chunks(fn, arg_list, deadline):
+    """
+    청크들을 워커에 나눠 제출하고 deadline까지 기다린다(청크도 같은 deadline에 스스로 멈춘다).
+    SEARCH_ADMIT_WAIT 안에 슬롯을 못 얻으면 SearchRejected, 마감까지 안 끝나면 대기 청크 취소 후 SearchRejected.
+    """
+    if not SEARCH_SLOTS.acquire(timeout=SEARCH_ADMIT_WAIT):
+        raise SearchRejected("검색 요청이 많습니다. 잠시 후 다시 시도하세요.")
+    try:
+        executor = search_executor()
+        if executor is None:
+            return [fn(*args) for args in arg_list]
+        futs = [executor.submit(fn, *args) for args in arg_list]
+        done, not_done = futures_wait(futs, timeout=max(0.0, deadline - time.time()) + 1.0)
+        if not_done:
+            for f in futs:
+                f.cancel()
+            raise SearchRejected(f"검색 시간 초과({SEARCH_TIMEOUT:g}초)")
+        return [f.result() for f in futs]
+    finally:
+        SEARCH_SLOTS.release()
+
+def parallel_lobby_pool(players, mode="all", rules=None, max_gap=None, slot=None):
+    must = lobby_must_play(players, rules, slot)
+    parts = max(1, SEARCH_WORKERS)
+    seed = random.getrandbits(32)
+    deadline = time.time() + SEARCH_TIMEOUT
+    chunks = [(players, mode, must, rules, max_gap, part, parts, seed + part, deadline) for part in range(parts)]
+    merged = {"exact": [], "five": [], "near": []}
+    for part in run_search_chunks(_lobby_chunk, chunks, deadline):
+        for k in merged:
+            merged[k] += part[k]
+    limit = LOBBY_POOL_LIMIT
+    if len(merged["near"]) > limit:   # 워커별 후보를 합친 뒤 상한만큼 무작위로 남긴다
+        keep = {id(b) for b in random.sample(merged["near"], limit)}
+        merged = {k: [b for b in v if id(b) in keep] for k, v in merged.items()}
+    return merged
+
+def lobby_must_play(players, rules=None, slot=None):
+    forced = rule_names(rules)
+    bench = LAST_BENCH.get(slot or RELAY_SLOT, set()) if LOBBY_BENCH_PRIORITY else set()
+    prior = [name for name, _ in players if name in bench and name not in forced]
+    room = max(0, 10 - len(forced))
+    return forced + (random.sample(prior, room) if len(prior) > room else prior)
+
+def build_match_pool(players, mode="all", rules=None, slot=None):
+    """10명이면 전수 탐색 풀, 그 이상이면 벤치(slot 채널의 지난 판 기준)를 포함한 로비 탐색 풀"""
+    if len(players) == 10:
+        return search_match_pool(players, rules=rules)
+    return parallel_lobby_pool(players, mode, rules, slot=slot)
+
+def match_cache_key(players, rules=None):
+    ordered = sorted(players, key=lambda p: p[0])
+    digest = hashlib.sha1(repr([tuple(sc[:5]) for _, sc in ordered]).encode()).hexdigest()
+    return tuple(name for name, _ in ordered), digest, rules_key(rules)
+
+def get_match_pool(players, mode="all", rules=None, slot=None):
+    """
+    10명 전수 탐색 풀은 LRU 캐시에서 꺼낸다(키: 정렬된 명단 + 점수 해시 → 점수가 바뀌면 자연히 새 키).
+    로비 탐색은 시간 예산/무작위 재시작 결과라 캐시하지 않는다.
+    """
+    if len(players) != 10:
+        return build_match_pool(players, mode, rules, slot)
+    key = match_cache_key(players, rules)
+    with MATCH_CACHE_LOCK:
+        pool = MATCH_CACHE.get(key)
+        if pool is not None:
+            MATCH_CACHE.move_to_end(key)
+            MATCH_CACHE_STATS["hits"] += 1
+            return pool
+        MATCH_CACHE_STATS["misses"] += 1
+    pool = build_match_pool(players, mode, rules)
+    with MATCH_CACHE_LOCK:
+        MATCH_CACHE[key] = pool
+        MATCH_CACHE.move_to_end(key)
+        while len(MATCH_CACHE) > MATCH_CACHE_SIZE:
+            MATCH_CACHE.popitem(last=False)
+            MATCH_CACHE_STATS["evictions"] += 1
+    return pool
+
+def match_cache_stats():
+    with MATCH_CACHE_LOCK:
+        return dict(MATCH_CACHE_STATS, size=len(MATCH_CACHE), limit=MATCH_CACHE_SIZE)
+
+def roster_error(names):
+    if len(names) < 10 or len(names) > LOBBY_MAX_PLAYERS:
+        return f"⚠️ 10~{LOBBY_MAX_PLAYERS}명의 멤버를 입력하세요. (10명 초과 시 벤치 자동 선정)"
+    return None
+
+def note_bench(roster, played, slot=None):
+    """지난 판 벤치 갱신(채널별) — 투표로 확정된 조합 기준"""
+    if roster:
+        LAST_BENCH[slot or RELAY_SLOT] = set(roster) - set(played)
+
+def pool_blocks(pool, mode):
+    if mode == "exact": return pool["exact"]
+    if mode == "five": return pool["five"]
+    return pool["exact"] + pool["five"]
+
+def pool_size(blocks):
+    return sum(len(la) * len(lb) for _, la, _, lb in blocks)
+
+def sample_match_indices(blocks, k=3, rng=random, exclude=()):
+    """
+    버킷 쌍을 평탄화한 인덱스 공간에서 비복원 추출 → 전체 목록에서 random.sample 한 것과 같은 분포
+    exclude: 이미 보여준 인덱스(다시뽑기에서 제외)
+    """
+    total = pool_size(blocks)
+    left = total - len(exclude)
+    if not exclude:
+        return rng.sample(range(total), min(k, total))
+    if left <= 2 * k:
+        rest = [i for i in range(total) if i not in exclude]
+        return rng.sample(rest, min(k, len(rest)))
+    picked = []
+    while len(picked) < k:
+        i = rng.randrange(total)
+        if i not in exclude and i not in picked:
+            picked.append(i)
+    return picked
+
+def pick_matches(blocks, indices):
+    offsets = list(itertools.accumulate(len(la) * len(lb) for _, la, _, lb in blocks))
+    picks = []
+    for idx in indices:
+        b = bisect.bisect_right(offsets, idx)
+        sa, la, sb, lb = blocks[b]
+        i, j = divmod(idx - (offsets[b-1] if b else 0), len(lb))
+        picks.append((sa, la[i], sb, lb[j]))
+    return picks
+
+def draw_and_remember(blocks, mode, title, raw_input_names, k=3, slot=None):
+    """추첨 후 그 채널의 /다시 에서 이어 뽑을 수 있도록 풀과 보여준 인덱스를 기록"""
+    indices = sample_match_indices(blocks, k)
+    slot = slot or RELAY_SLOT
+    with LAST_DRAW_LOCK:
+        LAST_DRAW[slot] = {"blocks": blocks, "shown": set(indices), "mode": mode, "title": title,
+                           "roster": raw_input_names}
+        LAST_DRAW.move_to_end(slot)
+        while len(LAST_DRAW) > LAST_DRAW_SLOTS:
+            LAST_DRAW.popitem(last=False)
+    return pick_matches(blocks, indices)
+
+def forget_draw(slot=None):
+    """스트리밍 탐색 결과는 풀이 없으므로 그 채널의 /다시 대상에서 뺀다"""
+    with LAST_DRAW_LOCK:
+        LAST_DRAW.pop(slot or RELAY_SLOT, None)
+
+def parse_seed(raw):
+    """/다시, 웹 다시뽑기 seed 입력: 정수가 아니면 None(무작위)"""
+    raw = str(raw if raw is not None else "").strip()
+    return int(raw) if re.fullmatch(r"-?[0-9]+", raw) else None
+
+def reroll_matches(seed=None, k=3, slot=None):
+    """
+    마지막 풀에서 이미 보여준 조합을 빼고 k개를 더 뽑는다(재계산 없음).
+    seed를 주면 같은 풀/같은 이력에서 같은 결과가 재현된다.
+    return: (matches, title, raw_input_names) 또는 뽑을 게 없으면 (None, 사유, "")
+    """
+    rng = random.Random(seed) if seed is not None else random
+    with LAST_DRAW_LOCK:
+        last = LAST_DRAW.get(slot or RELAY_SLOT)
+        if not last:
+            return None, "⚠️ 다시 뽑을 조합이 없습니다. 먼저 /내전 (all/exact/five)으로 생성하세요.", ""
+        blocks = last["blocks"]
+        indices = sample_match_indices(blocks, k, rng, exclude=last["shown"])
+        if not indices:
+            return None, "⚠️ 남은 조합이 없습니다. (모두 한 번씩 보여드렸어요)", ""
+        last["shown"].update(indices)
+        title = f"{last['title']} 다시뽑기" + (f" (seed {seed})" if seed is not None else "")
+        roster = last["roster"]
+    return pick_matches(blocks, indices), title, roster
+
+
+# --------------------------------
+# 스트리밍 탐색 (허용 차이 + 목적함수)
+#  - iter_match_blocks: |sa - sb| <= max_gap 버킷 쌍을 분할 단위로 하나씩 흘려보내는 제너레이터
+#  - 소비자는 블록(같은 sa/sb를 공유하는 조합 묶음) 단위로 힙/저수지만 유지 → 메모리 O(k)
+#    · top-k: OBJECTIVES 키가 작은 순 (기본: 차이 최소 → 총합 최대)
+#    · random: 허용 차이 안에서 균등 k개 (저수지 표본, Algorithm L)
+#    · first: 처음 찾은 k개에서 바로 중단(first-fit)
+# --------------------------------
+OBJECTIVES = {
+    "gap":   lambda sa, sb: (abs(sa - sb), -(sa + sb)),   # 차이 최소, 그다음 총합 최대
+    "skill": lambda sa, sb: (-(sa + sb), abs(sa - sb)),   # 총합 최대, 그다음 차이 최소
+}
+# /내전 mode, 웹 action → (objective, 제목)
+STREAM_MODES = {
+    "best":  ("gap",    "최소 차이 우선"),
+    "skill": ("skill",  "총합 우선"),
+    "near":  ("random", "허용 차이 랜덤"),
+    "first": ("first",  "빠른 조합"),
+}
+DEFAULT_MAX_GAP = 5
+
+def iter_match_blocks(players, max_gap=DEFAULT_MAX_GAP, memo=None, rng=None, rules=None):
+    memo = {} if memo is None else memo
+    splits = team_splits(players, rules)
+    if rng is not None:
+        splits = list(splits)
+        rng.shuffle(splits)
+    for ta_idx in splits:
+        tb_idx = tuple(i for i in range(10) if i not in ta_idx)
+        bkt_a = subset_buckets(players, ta_idx, memo)
+        bkt_b = subset_buckets(players, tb_idx, memo)
+        keys_b = sorted(bkt_b)
+        for sa, la in bkt_a.items():
+            lo = bisect.bisect_left(keys_b, sa - max_gap)
+            hi = bisect.bisect_right(keys_b, sa + max_gap)
+            for sb in keys_b[lo:hi]:
+                lb = bkt_b[sb]
+                yield (sa, la, sb, lb)
+                yield (sb, lb, sa, la)
+
+def block_item(block, i):
+    sa, la, sb, lb = block
+    ia, ib = divmod(i, len(lb))
+    return (sa, la[ia], sb, lb[ib])
+
+def top_k_matches(blocks, k=3, key=OBJECTIVES["gap"], rng=random):
+    heap, kept = [], 0   # 최악 블록이 heap[0] (키를 부호 반전해 최대 힙처럼 사용)
+    for blk in blocks:
+        sa, la, sb, lb = blk
+        cnt = len(la) * len(lb)
+        heapq.heappush(heap, (tuple(-x for x in key(sa, sb)), rng.random(), cnt, blk))
+        kept += cnt
+        while kept - heap[0][2] >= k:
+            kept -= heapq.heappop(heap)[2]
+    out = []
+    for _, _, cnt, blk in sorted(heap, reverse=True):
+        need = k - len(out)
+        if need <= 0: break
+        out.extend(block_item(blk, i) for i in rng.sample(range(cnt), min(need, cnt)))
+    return out
+
+def reservoir_matches(blocks, k=3, rng=random):
+    res, seen, nxt, w = [], 0, None, 1.0
+    def skip():
+        return int(math.log(rng.random() or 1e-12) / math.log(1 - w)) + 1
+    for blk in blocks:
+        start, cnt = seen, len(blk[1]) * len(blk[3])
+        seen += cnt
+        i = start
+        while i < seen and len(res) < k:
+            res.append(block_item(blk, i - start)); i += 1
+            if len(res) == k:
+                w = math.exp(math.log(rng.random() or 1e-12) / k)
+                nxt = (k - 1) + skip()
+        while nxt is not None and nxt < seen:
+            res[rng.randrange(k)] = block_item(blk, nxt - start)
+            w *= math.exp(math.log(rng.random() or 1e-12) / k)
+            nxt += skip()
+    rng.shuffle(res)
+    return res
+
+def first_fit_matches(blocks, k=3, rng=random):
+    out = []
+    for blk in blocks:
+        cnt = len(blk[1]) * len(blk[3])
+        out.extend(block_item(blk, i) for i in rng.sample(range(cnt), min(k - len(out), cnt)))
+        if len(out) >= k:
+            break   # 제너레이터라 나머지 분할은 계산하지 않음
+    return out
+
+def find_matches(players, k=3, max_gap=DEFAULT_MAX_GAP, objective="gap", rng=random, rules=None, slot=None):
+    if len(players) == 10:
+        blocks = iter_match_blocks(players, max_gap, rng=rng if objective == "first" else None, rules=rules)
+    else:
+        blocks = iter(parallel_lobby_pool(players, rules=rules, max_gap=max_gap, slot=slot)["near"])
+    if objective == "first":
+        return first_fit_matches(blocks, k, rng)
+    if objective == "random":
+        return reservoir_matches(blocks, k, rng)
+    return top_k_matches(blocks, k, OBJECTIVES[objective], rng)
+
+def parse_max_gap(raw):
+    raw = str(raw if raw is not None else "").strip()
+    return max(0, int(raw)) if re.fullmatch(r"[0-9]+", raw) else DEFAULT_MAX_GAP
+
+
+# --------------------------------
+# 표본 추출 엔진 (풀 없이 k개)
+#  - 기각 표본: 분할·방향·A/B 순열을 균등하게 뽑고 점수 차 조건을 만족하면 채택
+#    → 채택된 조합은 전수 풀에서 균등 추출한 것과 같은 분포, 메모리는 O(k)
+#  - 조건이 드물어 시도 상한(SAMPLER_MAX_TRIALS)을 넘기면 부분집합별 총점 히스토그램으로
+#    (분할, sa, sb)를 |A_sa|·|B_sb| 가중치로 고른 뒤 그 점수의 순열을 균등 선택(정확히 균등)
+# --------------------------------
+def _perm_total(players, idx, perm):
+    total = 0
+    for i, pos in zip(idx, perm):
+        v = players[i][1][pos]
+        if v <= 0:
+            return None
+        total += v
+    return total
+
+def _build_match(players, ta, pa, tb, pb):
+    def team(idx, perm):
+        asg = [None] * 5
+        for i, pos in zip(idx, perm):
+            name, scores = players[i]
+            asg[pos] = (positions[pos], name, scores[pos])
+        return asg
+    aa, bb = team(ta, pa), team(tb, pb)
+    return (sum(x[2] for x in aa), aa, sum(x[2] for x in bb), bb)
+
+def _score_hist(players, idx):
+    hist = defaultdict(int)
+    for perm in valid_lane_perms([players[i] for i in idx]):
+        hist[_perm_total(players, idx, perm)] += 1
+    return hist
+
+def weighted_split_matches(players, gaps, k, splits, comps, rng=random, seen=None):
+    seen = set() if seen is None else seen
+    entries, weights = [], []
+    for s, (ta, tb) in enumerate(zip(splits, comps)):
+        ha, hb = _score_hist(players, ta), _score_hist(players, tb)
+        for sa, ca in ha.items():
+            for sb in {sa + g for g in gaps} | {sa - g for g in gaps}:
+                if hb.get(sb):
+                    entries.append((s, sa, sb)); weights.append(ca * hb[sb])
+    total = 2 * sum(weights)   # A/B 방향 포함 전체 조합 수
+    out = []
+    offsets = list(itertools.accumulate(weights))
+    while entries and len(out) < k and len(seen) < total:
+        s, sa, sb = entries[bisect.bisect_right(offsets, rng.randrange(offsets[-1]))]
+        ta, tb = splits[s], comps[s]
+        pa = rng.choice([p for p in valid_lane_perms([players[i] for i in ta]) if _perm_total(players, ta, p) == sa])
+        pb = rng.choice([p for p in valid_lane_perms([players[i] for i in tb]) if _perm_total(players, tb, p) == sb])
+        if rng.random() < 0.5:
+            ta, pa, tb, pb = tb, pb, ta, pa
+        key = (ta, pa, pb)
+        if key not in seen:
+            seen.add(key); out.append(_build_match(players, ta, pa, tb, pb))
+    return out
+
+def sample_split_matches(players, gaps, k=3, rules=None, rng=random, max_trials=None):
+    splits = list(team_splits(players, rules))
+    if not splits:
+        return []
+    comps = [tuple(i for i in range(len(players)) if i not in sp) for sp in splits]
+    seen, out = set(), []
+    for _ in range(SAMPLER_MAX_TRIALS if max_trials is None else max_trials):
+        if len(out) >= k:
+            return out
+        s = rng.randrange(len(splits))
+        ta, tb = (splits[s], comps[s]) if rng.random() < 0.5 else (comps[s], splits[s])
+        pa, pb = rng.choice(ALL_PERMS), rng.choice(ALL_PERMS)
+        sa = _perm_total(players, ta, pa)
+        sb = _perm_total(players, tb, pb) if sa is not None else None
+        if sb is None or abs(sa - sb) not in gaps:
+            continue
+        key = (ta, pa, pb)
+        if key not in seen:
+            seen.add(key); out.append(_build_match(players, ta, pa, tb, pb))
+    if len(out) >= k:
+        return out
+    return out + weighted_split_matches(players, gaps, k - len(out), splits, comps, rng, seen)
+
+def draw_mode_matches(players, mode, rules, raw_input_names, k=3, slot=None):
+    """exact/five/all 추첨: MATCH_ENGINE에 따라 전수 풀(다시뽑기 가능) 또는 표본 추출"""
+    if MATCH_ENGINE == "sampling" and len(players) == 10:
+        forget_draw(slot)
+        return sample_split_matches(players, MODE_GAPS[mode], k, rules)
+    blocks = pool_blocks(get_match_pool(players, mode, rules, slot), mode)
+    return draw_and_remember(blocks, mode, MODE_TITLES[mode], raw_input_names, k, slot)
+
+def sampler_distribution_report(players, mode="all", draws=3000, rng=random):
+    """
+    표본 엔진 vs 전수 풀: (sa, sb) 점수쌍 분포의 총변동거리(TV)와 카이제곱.
+    표본 추출이 균등하면 TV는 draws가 늘수록 0에 가까워진다.
+    """
+    gaps = MODE_GAPS[mode]
+    blocks = pool_blocks(search_match_pool(players), mode)
+    expect = defaultdict(int)
+    for sa, la, sb, lb in blocks:
+        expect[(sa, sb)] += len(la) * len(lb)
+    total = sum(expect.values())
+    got = defaultdict(int)
+    for _ in range(draws):
+        for sa, _, sb, _ in sample_split_matches(players, gaps, 1, rng=rng):
+            got[(sa, sb)] += 1
+    n = sum(got.values())
+    if not total or not n:
+        return {"pool_size": total, "draws": n}
+    keys = set(expect) | set(got)
+    tv = sum(abs(expect[k_] / total - got[k_] / n) for k_ in keys) / 2
+    chi2 = sum((got[k_] - n * expect[k_] / total) ** 2 / (n * expect[k_] / total) for k_ in expect)
+    return {"pool_size": total, "draws": n, "cells": len(expect), "tv_distance": round(tv, 4),
+            "chi2": round(chi2, 2), "dof": len(expect) - 1}
+
 
 # --------------------------------
 # Discord 송출 (GAS 릴레이)
+#  - 모든 전송은 OUTBOX 큐에 넣고, 워커 스레드 하나가 토큰 버킷에 맞춰 보낸다
+#  - 호출한 쪽은 Future(각 메시지 성공 여부 목록)를 받고 바로 돌아간다 → 요청 스레드에서 sleep 없음
+#  - 한 번에 넣은 메시지 묶음은 순서대로, 다른 묶음과 섞이지 않게 보낸다
 # --------------------------------
-def send_to_discord_text(content):
-    global LAST_SEND_TS
-    now = time.time()
-    wait = MIN_INTERVAL - (now - LAST_SEND_TS)
-    if wait > 0: time.sleep(wait)
-    url = f"{RELAY_BASE}?key={RELAY_KEY}"
-    payload = {"content": content}
+OUTBOX = queue.Queue()
+RELAY_LOCK = threading.Lock()
+RELAY_BUCKET = {"tokens": float(RELAY_BURST), "ts": time.monotonic()}
+RELAY_STATE = {"worker": None, "sent": 0, "failed": 0, "session": None,
+               "raw_ok": {"1": True, "0": False}.get(RELAY_RAW)}   # None = 아직 모름
+
+def http_session():
+    """릴레이/Discord 웹훅용 keep-alive 세션 하나를 재사용(매번 TLS 핸드셰이크 안 함), 5xx/연결 오류는 백오프 재시도"""
+    with RELAY_LOCK:
+        if RELAY_STATE["session"] is None:
+            retry = urllib3.util.Retry(total=RELAY_RETRIES, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                                       allowed_methods=None, raise_on_status=False)
+            session = requests.Session()
+            session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retry))
+            session.headers["Content-Type"] = "application/json"
+            RELAY_STATE["session"] = session
+        return RELAY_STATE["session"]
+
+def _relay_send(payload, tag):
+    """return: (성공 여부, 릴레이가 답했는지) — 예외/5xx면 답하지 않은 것으로 본다"""
     try:
-        resp = requests.post(url, json=payload, timeout=12, headers={"Content-Type":"application/json"})
+        resp = http_session().post(f"{RELAY_BASE}?key={RELAY_KEY}", json=payload, timeout=12)
     except Exception as e:
-        print(f"[RELAY] 예외: {repr(e)}", file=sys.stderr); return False
-    print(f"[RELAY] status={resp.status_code} body[:200]={resp.text[:200]!r}", file=sys.stderr)
-    if 200 <= resp.status_code < 300 and (resp.text or "").startswith("ok"):
-        LAST_SEND_TS = time.time(); return True
-    return False
+        print(f"[{tag}] 예외: {repr(e)}", file=sys.stderr); return False, False
+    print(f"[{tag}] status={resp.status_code} body[:200]={resp.text[:200]!r}", file=sys.stderr)
+    return 200 <= resp.status_code < 300 and (resp.text or "").startswith("ok"), resp.status_code < 500
+
+def _relay_post(payload, tag):
+    """return: 응답 본문이 "ok"로 시작하면 True"""
+    return _relay_send(payload, tag)[0]
+
+def _relay_take_token():
+    while True:
+        with RELAY_LOCK:
+            now = time.monotonic()
+            RELAY_BUCKET["tokens"] = min(RELAY_BURST, RELAY_BUCKET["tokens"] + (now - RELAY_BUCKET["ts"]) * RELAY_RATE)
+            RELAY_BUCKET["ts"] = now
+            if RELAY_BUCKET["tokens"] >= 1:
+                RELAY_BUCKET["tokens"] -= 1
+                return
+            wait = (1 - RELAY_BUCKET["tokens"]) / RELAY_RATE
+        time.sleep(wait)
+
+def _relay_text(content):
+    _relay_take_token()
+    return _relay_post({"content": content}, "RELAY")
+
+def _relay_json(obj):
+    """
+    raw(버튼 포함) 포워딩 지원 여부는 처음 한 번 확인해 캐시 → 논리적 메시지 하나당 실제 전송 하나.
+    지원 안 하면 텍스트만 보낸다(버튼은 미표시).
+    """
+    text = obj.get("content") if isinstance(obj, dict) else None
+    if RELAY_STATE["raw_ok"] is not False:
+        _relay_take_token()
+        ok, answered = _relay_send({"raw": obj}, "RELAY-JSON")
+        if ok or (answered and RELAY_STATE["raw_ok"] is None):   # 전송 오류/5xx로는 "미지원"을 정하지 않는다
+            if RELAY_STATE["raw_ok"] is None:
+                print(f"[RELAY-JSON] raw 포워딩 {'지원' if ok else '미지원 → 이후 텍스트로만 전송'}", file=sys.stderr)
+            RELAY_STATE["raw_ok"] = ok
+        if ok:
+            return True
+    return _relay_text(text) if text else False
+
+def _relay_loop():
+    while True:
+        msgs, fut = OUTBOX.get()
+        try:
+            if not fut.set_running_or_notify_cancel():
+                continue
+            results = []
+            for m in msgs:
+                ok = _relay_json(m) if isinstance(m, dict) else _relay_text(m)
+                RELAY_STATE["sent" if ok else "failed"] += 1
+                results.append(ok)
+            fut.set_result(results)
+        except Exception as e:
+            fut.set_exception(e)
+        finally:
+            OUTBOX.task_done()
+
+def send_messages(msgs):
+    """msgs: 문자열(텍스트) 또는 dict(raw JSON) 목록. return: Future → [성공 여부...]"""
+    fut = Future()
+    with RELAY_LOCK:
+        if RELAY_STATE["worker"] is None:
+            RELAY_STATE["worker"] = threading.Thread(target=_relay_loop, daemon=True)
+            RELAY_STATE["worker"].start()
+        OUTBOX.put((list(msgs), fut))
+    return fut
+
+def send_to_discord_text(content):
+    return send_messages([content])
 
-def send_to_discord_json(obj):
+def pack_for_discord(blocks, limit=2000, sep="\n\n"):
     """
-    GAS가 raw 포워딩을 지원하지 않아도, 내용은 반드시 나오게 폴백도 함께 보낸다.
-    (버튼은 미표시)
+    Discord는 2000자 제한 → 블록(조합 하나, 미기록 목록, 투표 안내 등)을 최대한 적은 메시지로 묶는다.
+    블록은 메시지 경계에서 자르지 않고, limit보다 긴 블록만 줄 단위로 나눈다(``` 는 닫았다가 다음 메시지에서 다시 연다).
     """
-    global LAST_SEND_TS
+    if isinstance(blocks, str):
+        blocks = [blocks]
+    msgs, cur = [], ""
+    for block in blocks:
+        if not block:
+            continue
+        pieces = [block] if len(block) <= limit else _split_lines(block, limit)
+        for piece in pieces:
+            if cur and len(cur) + len(sep) + len(piece) <= limit:
+                cur += sep + piece
+            else:
+                if cur:
+                    msgs.append(cur)
+                cur = piece
+    if cur:
+        msgs.append(cur)
+    return msgs
+
+def _split_lines(text, limit):
+    fence_close = "\n```"
+    width = limit - 2 * len(fence_close)   # 한 줄이 이보다 길면 글자 단위로 자른다
+    out, cur, fence = [], [], False
+    for line in text.split("\n"):
+        for seg in [line[i:i + width] for i in range(0, max(len(line), 1), width)]:
+            if cur and len("\n".join(cur + [seg])) + len(fence_close) > limit:
+                out.append("\n".join(cur + (["```"] if fence else [])))
+                cur = ["```"] if fence else []
+            cur.append(seg)
+            if seg.lstrip().startswith("```"):
+                fence = not fence
+    if cur:
+        out.append("\n".join(cur))
+    return out
+
+def send_long_to_discord(content):
+    """content: 문자열 하나 또는 블록 목록"""
+    return send_messages(pack_for_discord(content))
+
+def drain_outbox(timeout=15):
+    """종료 직전: 큐에 남은 메시지를 잠깐 기다려 준다"""
+    deadline = time.time() + timeout
+    while OUTBOX.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.1)
+
+atexit.register(drain_outbox)
+
+def relay_stats():
+    with RELAY_LOCK:
+        return {"queued": OUTBOX.qsize(), "sent": RELAY_STATE["sent"], "failed": RELAY_STATE["failed"],
+                "tokens": round(RELAY_BUCKET["tokens"], 2), "rate": RELAY_RATE, "burst": RELAY_BURST,
+                "raw_ok": RELAY_STATE["raw_ok"]}
+
+# --------------------------------
+# 슬래시 명령 작업 큐
+#  - 명령은 type 5(지연 응답)로 바로 답하고, 고정된 워커(JOB_WORKERS)가 큐에서 꺼내 처리
+#  - 결과는 GAS 릴레이 대신 Discord 후속 웹훅(interaction token)으로 직접 → 네트워크 한 번
+#  - key가 같은 작업(같은 명단/모드의 /내전 등)이 대기/실행 중이면 새로 넣지 않고 그 작업을 공유
+#  - 상태: /jobs, /jobs/<id>
+# --------------------------------
+class JobRejected(Exception):
+    pass
+
+JOB_QUEUE = queue.Queue(maxsize=max(1, JOB_QUEUE_LIMIT))
+JOBS = OrderedDict()          # id → 상태(만든 순서)
+JOB_KEYS = {}                 # key → 대기/실행 중인 작업 id
+JOBS_LOCK = threading.Lock()
+JOB_WORKER_THREADS = []
+
+def _job_view(job):
+    return {k: v for k, v in job.items() if k != "key"}
+
+def _prune_jobs(now):
+    while JOBS:
+        job = next(iter(JOBS.values()))
+        if job["finished_at"] is None or now - job["finished_at"] < JOB_KEEP_SEC:
+            break
+        JOBS.popitem(last=False)
+
+def submit_job(kind, fn, args=(), key=None):
+    """return: (작업 상태, 새로 넣었는지). 큐가 가득 차면 JobRejected"""
     now = time.time()
-    wait = MIN_INTERVAL - (now - LAST_SEND_TS)
-    if wait > 0: time.sleep(wait)
-    url = f"{RELAY_BASE}?key={RELAY_KEY}"
+    with JOBS_LOCK:
+        _prune_jobs(now)
+        if key is not None and key in JOB_KEYS:
+            return _job_view(JOBS[JOB_KEYS[key]]), False
+        job = {"id": uuid.uuid4().hex[:8], "kind": kind, "key": key, "status": "queued",
+               "created_at": now, "started_at": None, "finished_at": None, "error": None}
+        try:
+            JOB_QUEUE.put_nowait((job, fn, args))
+        except queue.Full:
+            raise JobRejected("요청이 밀려 있습니다. 잠시 후 다시 시도하세요.")
+        JOBS[job["id"]] = job
+        if key is not None:
+            JOB_KEYS[key] = job["id"]
+        while len(JOB_WORKER_THREADS) < max(1, JOB_WORKERS):
+            t = threading.Thread(target=_job_loop, daemon=True)
+            t.start()
+            JOB_WORKER_THREADS.append(t)
+        return _job_view(job), True
+
+def _job_loop():
+    while True:
+        job, fn, args = JOB_QUEUE.get()
+        with JOBS_LOCK:
+            job.update(status="running", started_at=time.time())
+        try:
+            fn(*args)
+            status, error = "done", None
+        except Exception as e:
+            print(f"⚠️ 작업 실패({job['kind']} {job['id']}):", e, file=sys.stderr)
+            status, error = "failed", str(e)
+        with JOBS_LOCK:
+            job.update(status=status, error=error, finished_at=time.time())
+            if JOB_KEYS.get(job["key"]) == job["id"]:
+                del JOB_KEYS[job["key"]]
+        JOB_QUEUE.task_done()
+
+def get_job(job_id):
+    with JOBS_LOCK:
+        job = JOBS.get(job_id)
+        return _job_view(job) if job else None
+
+def job_stats():
+    with JOBS_LOCK:
+        counts = defaultdict(int)
+        for job in JOBS.values():
+            counts[job["status"]] += 1
+        return dict(counts, queued_now=JOB_QUEUE.qsize(), workers=len(JOB_WORKER_THREADS), limit=JOB_QUEUE_LIMIT)
+
+def followup_sender(payload, edit_original=True):
+    """
+    지연 응답한 interaction에 결과를 올리는 send(msgs). 첫 메시지는 '생각 중…' 원본을 고치고 나머지는 후속 메시지.
+    edit_original=False면 모두 새 후속 메시지(자동 공개처럼 나중에 따로 올릴 때).
+    토큰이 없거나(15분 만료 등) 웹훅이 실패하면 남은 메시지는 릴레이로 보낸다.
+    """
+    app_id, token = payload.get("application_id"), payload.get("token")
+    if not app_id or not token:
+        return send_messages
+    base = f"{DISCORD_API}/webhooks/{app_id}/{token}"
+    def send(msgs):
+        msgs = list(msgs)
+        for i, m in enumerate(msgs):
+            body = m if isinstance(m, dict) else {"content": m}
+            try:
+                if i == 0 and edit_original:
+                    resp = http_session().patch(f"{base}/messages/@original", json=body, timeout=12)
+                else:
+                    resp = http_session().post(base, json=body, timeout=12)
+                print(f"[FOLLOWUP] status={resp.status_code}", file=sys.stderr)
+                if 200 <= resp.status_code < 300:
+                    continue
+            except Exception as e:
+                print(f"[FOLLOWUP] 예외: {repr(e)}", file=sys.stderr)
+            return send_messages(msgs[i:])
+    return send
+
+def interaction_slot(payload):
+    """투표 슬롯: 서버(guild) + 채널. 채널을 모르면 릴레이 슬롯"""
+    channel = payload.get("channel_id") or (payload.get("channel") or {}).get("id")
+    return f"{payload.get('guild_id') or 'dm'}:{channel}" if channel else RELAY_SLOT
 
-    # 1) 원래 시도 (GAS가 raw 지원하면 버튼 포함으로 보일 수 있음)
+# --------------------------------
+# 투표 자동 공개 스케줄러
+#  - (마감 시각, 순번, pid, send, 슬롯)을 힙 하나에 넣고 스레드 하나가 가장 이른 마감까지 기다린다
+#  - 마감이 되면 투표를 닫고(이미 /공개로 닫혔으면 아무것도 안 함) 공개 작업을 작업 큐에 넣는다
+#  - 슬롯(채널)마다 잠금: 같은 채널에서 새 투표 만들기/공개가 섞이지 않게
+# --------------------------------
+SCHED_HEAP = []
+SCHED_COND = threading.Condition()
+SCHED_SEQ = itertools.count()
+SCHED_STATE = {"thread": None, "fired": 0}
+SLOT_LOCKS = defaultdict(threading.Lock)
+SLOT_LOCKS_LOCK = threading.Lock()
+
+def slot_lock(slot):
+    with SLOT_LOCKS_LOCK:
+        return SLOT_LOCKS[slot]
+
+def schedule_poll_close(pid, deadline, send, slot=None):
+    with SCHED_COND:
+        heapq.heappush(SCHED_HEAP, (deadline, next(SCHED_SEQ), pid, send, slot))
+        if SCHED_STATE["thread"] is None:
+            SCHED_STATE["thread"] = threading.Thread(target=_scheduler_loop, daemon=True)
+            SCHED_STATE["thread"].start()
+        SCHED_COND.notify()   # 새 마감이 더 이르면 다시 계산
+
+def _scheduler_loop():
+    while True:
+        with SCHED_COND:
+            while not SCHED_HEAP or SCHED_HEAP[0][0] > time.time():
+                SCHED_COND.wait(SCHED_HEAP[0][0] - time.time() if SCHED_HEAP else None)
+            _, _, pid, send, slot = heapq.heappop(SCHED_HEAP)
+        try:
+            _auto_close_poll(pid, send, slot)
+        except Exception as e:
+            print("⚠️ 투표 자동 공개 실패:", e, file=sys.stderr)
+
+def _auto_close_poll(pid, send, slot=None):
+    snap = poll_store().close(pid)
+    if not snap:
+        return   # 이미 공개됨/교체됨/만료
+    SCHED_STATE["fired"] += 1
+    args = (snap["options"], snap["option_links"], snap["votes"], snap["roster"], send, slot)
     try:
-        resp = requests.post(url, json={"raw": obj}, timeout=12,
-                             headers={"Content-Type": "application/json"})
-        print(f"[RELAY-JSON] status={resp.status_code} body[:200]={resp.text[:200]!r}", file=sys.stderr)
-        # 성공이든 아니든 타임스탬프만 업데이트
-        LAST_SEND_TS = time.time()
-    except Exception as e:
-        print(f"[RELAY-JSON] 예외: {repr(e)}", file=sys.stderr)
+        submit_job("자동공개", _publish_poll_snapshot_async, args)
+    except JobRejected:
+        _publish_poll_snapshot_async(*args)
 
-    # 2) 무조건 텍스트 폴백도 보냄(중복 방지하려면 원한다면 환경변수로 제어)
-    text = obj.get("content") if isinstance(obj, dict) else None
-    if text:
-        send_to_discord_text(text)
-        return True
-    return False
+def scheduler_stats():
+    with SCHED_COND:
+        return {"scheduled": len(SCHED_HEAP), "fired": SCHED_STATE["fired"],
+                "next_in": round(SCHED_HEAP[0][0] - time.time(), 1) if SCHED_HEAP else None}
 
+def current_poll_id(slot):
+    """이 채널의 투표, 없으면 릴레이 채널 투표(웹에서 만든 조합)"""
+    store = poll_store()
+    return store.current(slot) or (store.current(RELAY_SLOT) if slot != RELAY_SLOT else None)
 
-def send_long_to_discord(content):
+# --------------------------------
+# 조합 ID 등록부
+#  - 조합(A 5명 + B 5명, 라인 순서 그대로)마다 짧은 ID: 정규화한 명단의 SHA-1 → base62 10자
+#    같은 조합이면 어느 프로세스에서 만들어도 같은 ID. A/B를 뒤집으면 다른 ID(버튼의 A/B가 그대로 유지되도록)
+#  - 명단과 라인별 점수를 한 번만 저장, 링크/버튼/pending/결과 저장은 ID로 O(1) 조회
+#  - 메모리 LRU 앞단 + MATCH_DB(재시작/여러 워커 공유)
+# --------------------------------
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+MATCH_ID_LEN = 10
+MATCH_REGISTRY = OrderedDict()   # id → {"id","a","b","scores_a","scores_b"}
+MATCH_REGISTRY_SIZE = 1024
+MATCH_REGISTRY_LOCK = threading.Lock()
+MATCH_REGISTRY_STATE = {"ready": False}
+
+def _match_db():
+    conn = sqlite3.connect(MATCH_DB, timeout=10)
+    if not MATCH_REGISTRY_STATE["ready"]:
+        conn.execute("CREATE TABLE IF NOT EXISTS matches (id TEXT PRIMARY KEY, data TEXT, created_at REAL)")
+        conn.commit()
+        MATCH_REGISTRY_STATE["ready"] = True
+    return conn
+
+def match_id(a_names, b_names):
+    digest = int.from_bytes(hashlib.sha1((",".join(a_names) + "|" + ",".join(b_names)).encode("utf-8")).digest()[:8], "big")
+    out = []
+    for _ in range(MATCH_ID_LEN):
+        digest, d = divmod(digest, 62)
+        out.append(BASE62[d])
+    return "".join(out)
+
+def _remember_match(match):
+    MATCH_REGISTRY[match["id"]] = match
+    MATCH_REGISTRY.move_to_end(match["id"])
+    while len(MATCH_REGISTRY) > MATCH_REGISTRY_SIZE:
+        MATCH_REGISTRY.popitem(last=False)
+
+def register_match(team_a, team_b):
     """
-    Discord는 2000자 제한이 있으므로 길면 나눠서 전송
+    team: [(포지션, 이름, 점수)] × 5. return: 조합 ID
+    같은 조합이 다른 점수로 다시 등록되면(점수표 수정 후) 저장된 점수를 새 값으로 바꾸고 캐시된 페이지를 버린다.
     """
-    limit = 2000
-    chunks = [content[i:i+limit] for i in range(0, len(content), limit)]
-    for chunk in chunks:
-        send_to_discord_text(chunk)  # 기존에 있는 Discord 전송 함수 사용
+    a_names, b_names = [p[1] for p in team_a], [p[1] for p in team_b]
+    mid = match_id(a_names, b_names)
+    match = {"id": mid, "a": a_names, "b": b_names,
+             "scores_a": [p[2] for p in team_a], "scores_b": [p[2] for p in team_b]}
+    with MATCH_REGISTRY_LOCK:
+        if MATCH_REGISTRY.get(mid) == match:
+            MATCH_REGISTRY.move_to_end(mid)
+            return mid
+        _remember_match(match)
+    drop_cached_page(("code", mid))
+    try:
+        conn = _match_db()
+        try:
+            conn.execute("INSERT INTO matches VALUES (?,?,?) ON CONFLICT(id) DO UPDATE SET data=excluded.data",
+                         (mid, json.dumps(match, ensure_ascii=False), time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        print("⚠️ 조합 등록 저장 실패:", e, file=sys.stderr)
+    return mid
+
+def get_match(mid):
+    with MATCH_REGISTRY_LOCK:
+        match = MATCH_REGISTRY.get(mid)
+        if match:
+            MATCH_REGISTRY.move_to_end(mid)
+            return match
+    try:
+        conn = _match_db()
+        try:
+            row = conn.execute("SELECT data FROM matches WHERE id=?", (mid,)).fetchone()
+        finally:
+            conn.close()
+    except Exception as e:
+        print("⚠️ 조합 조회 실패:", e, file=sys.stderr)
+        return None
+    if not row:
+        return None
+    match = json.loads(row[0])
+    with MATCH_REGISTRY_LOCK:
+        _remember_match(match)
+    return match
+
+def match_link(mid):
+    return f"{BASE_URL}/조합코드?id={mid}"
+
+def link_match_id(link):
+    """ID 링크면 ID, 예전 a=..&b=.. 링크면 None"""
+    try:
+        return (urllib.parse.parse_qs(urllib.parse.urlparse(link).query).get("id") or [None])[0]
+    except Exception:
+        return None
 
 # --------------------------------
-# 조합 송출 + CURRENT_POLL 저장
+# 조합 송출 + 현재 투표 저장
 # --------------------------------
-def send_to_discord_with_code(matches, title, raw_input_names):
+def send_to_discord_with_code(matches, title, raw_input_names, send=send_messages, slot=RELAY_SLOT, close_send=None):
+    roster = parse_names_only(raw_input_names)
     all_msgs, option_links = [], []
     for idx, (score_a, team_a, score_b, team_b) in enumerate(matches, 1):
-        link = f"{BASE_URL}/조합코드?a={','.join([p[1] for p in team_a])}&b={','.join([p[1] for p in team_b])}"
+        link = match_link(register_match(team_a, team_b))
         option_links.append(link)
+        playing = {p[1] for p in team_a + team_b}
+        bench = [n for n in roster if n not in playing]
         lines = [
             f"**{title} 조합 {idx}**",
-            f"총합 A: {score_a} / 총합 B: {score_b}",
+            f"총합 A: {score_a} / 총합 B: {score_b}" + (f" / 벤치: {', '.join(bench)}" if bench else ""),
             "```",
             f"{'Team A':<25} | {'Team B':<25}",
             "-"*53
@@ -305,23 +2436,32 @@ def send_to_discord_with_code(matches, title, raw_input_names):
             lines.append(f"{pa}: {na} ({sa})".ljust(23) + " | " + f"{pb}: {nb} ({sb})")
         lines.append("```")
         all_msgs.append("\n".join(lines))
-    send_long_to_discord("\n\n".join(all_msgs))
 
     labels = [f"{i}번" for i in range(1, len(option_links)+1)]
-    vote_link, end_link = make_poll_links(f"{title} 전체 투표", labels, option_links)
-    send_to_discord_text(f"/투표를 통해 투표를 하세요, 3분이지나거나 투표를 종료하려면 /공개 를 하세요 \n 비상용\n 🗳️ 웹투표: {vote_link}\n⏹️ 종료: {end_link}")
-
-    with POLL_LOCK:
-        CURRENT_POLL["options"] = labels[:]
-        CURRENT_POLL["option_links"] = option_links[:]
-        CURRENT_POLL["votes"].clear()
-        CURRENT_POLL["created_at"] = int(time.time())
+    vote_link, end_link = make_poll_links(f"{title} 전체 투표", labels, option_links, roster=roster)
+    # 조합 → 투표 안내를 한 묶음으로(동시에 돌린 다른 내전 메시지와 섞이지 않게)
+    send(pack_for_discord(all_msgs +
+                          [f"/투표를 통해 투표를 하세요, {POLL_DURATION / 60:g}분이 지나면 자동 공개, 먼저 종료하려면 /공개 를 하세요 \n 비상용\n 🗳️ 웹투표: {vote_link}\n⏹️ 종료: {end_link}"]))
+
+    # 슬래시 익명 투표용 최신 세트(3개 조합) — 채널마다 하나, 웹 투표와는 표를 따로 센다
+    store = poll_store()
+    with slot_lock(slot):
+        old = store.current(slot)
+        if old:
+            store.close(old)   # 같은 채널의 이전 투표는 공개 없이 교체
+        pid = store.create(f"{title} 슬래시 투표", labels, option_links, roster)
+        store.set_current(slot, pid)
+    schedule_poll_close(pid, time.time() + POLL_DURATION, close_send or send, slot)
 
 
 # --------------------------------
 # 공개 메시지(기록 링크 + 기록담당 + 버튼)
 # --------------------------------
 def _parse_names_from_code_link(link: str):
+    mid = link_match_id(link)
+    if mid:
+        match = get_match(mid)
+        return (list(match["a"]), list(match["b"])) if match else ([], [])
     try:
         qs = urllib.parse.parse_qs(urllib.parse.urlparse(link).query)
         a = [x.strip() for x in (qs.get("a", [""])[0] or "").split(",") if x.strip()]
@@ -330,7 +2470,7 @@ def _parse_names_from_code_link(link: str):
     except Exception:
         return [], []
 
-def _publish_poll_snapshot_async(options, option_links, votes):
+def _publish_poll_snapshot_async(options, option_links, votes, roster=None, send=send_messages, slot=None):
     try:
         # 집계
         counts = defaultdict(int)
@@ -364,108 +2504,133 @@ def _publish_poll_snapshot_async(options, option_links, votes):
             a_names, b_names = _parse_names_from_code_link(picked)
             ten = a_names + b_names if (len(a_names)==5 and len(b_names)==5) else []
             recorder = random.choice(ten) if ten else "기록담당(랜덤 실패)"
+            note_bench(roster, ten, slot)
             lines.append(f"🧾 **승/패 기록 링크**: {picked}")
             lines.append(f"📝 **오늘의 기록담당**: {recorder}")
-            # 버튼(components) — 1R, 2R
+            # 버튼(components) — 1R, 2R. custom_id에는 조합 ID(100자 제한), 예전 링크면 인코딩한 링크
+            ref = link_match_id(picked) or urllib.parse.quote_plus(picked)
             components = [{
                 "type": 1,
                 "components": [
-                    {"type":2, "style":3, "label":"1R A 승리", "custom_id": f"res|1|A|{urllib.parse.quote_plus(picked)}"},
-                    {"type":2, "style":4, "label":"1R B 승리", "custom_id": f"res|1|B|{urllib.parse.quote_plus(picked)}"}
+                    {"type":2, "style":3, "label":"1R A 승리", "custom_id": f"res|1|A|{ref}"},
+                    {"type":2, "style":4, "label":"1R B 승리", "custom_id": f"res|1|B|{ref}"}
                 ]
             }, {
                 "type": 1,
                 "components": [
-                    {"type":2, "style":3, "label":"2R A 승리", "custom_id": f"res|2|A|{urllib.parse.quote_plus(picked)}"},
-                    {"type":2, "style":4, "label":"2R B 승리", "custom_id": f"res|2|B|{urllib.parse.quote_plus(picked)}"},
-                    {"type":2, "style":2, "label":"2R 진행 안 함", "custom_id": f"res|2|N|{urllib.parse.quote_plus(picked)}"}
+                    {"type":2, "style":3, "label":"2R A 승리", "custom_id": f"res|2|A|{ref}"},
+                    {"type":2, "style":4, "label":"2R B 승리", "custom_id": f"res|2|B|{ref}"},
+                    {"type":2, "style":2, "label":"2R 진행 안 함", "custom_id": f"res|2|N|{ref}"}
                 ]
             }]
-            # 버튼 포함 송출 (GAS가 raw 그대로 webhook에 POST 하도록)
-            send_to_discord_json({"content": "\n".join(lines), "components": components})
+        blocks = ["\n".join(lines)]
+        if unresolved:
+            blocks.append("⚠️ 이전에 승패가 기록되지 않은 조합:\n" + "\n".join(f"- {u}" for u in unresolved))
+        msgs = pack_for_discord(blocks)
+        if winner_idx is not None:
+            # 버튼 포함 송출 (GAS가 raw 그대로 webhook에 POST 하도록) — 버튼은 결과가 든 첫 메시지에
+            send([{"content": msgs[0], "components": components}] + msgs[1:])
             pending_add(picked)
         else:
-            send_long_to_discord("\n".join(lines))
-
-        if unresolved:
-            send_long_to_discord("⚠️ 이전에 승패가 기록되지 않은 조합:\n" + "\n".join(f"- {u}" for u in unresolved))
+            send(msgs)
+        flush_writes()
     except Exception as e:
-        send_to_discord_text(f"⚠️ 공개 처리 실패: {e}")
+        send([f"⚠️ 공개 처리 실패: {e}"])
 
 
 # --------------------------------
 # 내전 처리(백그라운드, 이름만)
 # --------------------------------
-def process_match_and_send(members_text: str, mode: str):
+def process_match_and_send(members_text: str, mode: str, max_gap=DEFAULT_MAX_GAP, rules_text="", send=send_messages,
+                           slot=RELAY_SLOT, close_send=None):
     try:
         names = parse_names_only(normalize_members_text(members_text))
-        if len(names) != 10:
-            send_to_discord_text("⚠️ 정확히 10명의 멤버를 입력하세요."); return
+        err = roster_error(names)
+        if err:
+            send([err]); return
         scores_map = load_scores_map()
         missing = [n for n in names if n not in scores_map]
         if missing:
-            send_to_discord_text(f"⚠️ 시트 '{SCORES_WS}'에서 점수를 찾지 못한 이름: {', '.join(missing)}"); return
-
-        players = [(n, scores_map[n]) for n in names]
-        exact, five = [], []
-        for team_a in itertools.combinations(range(10), 5):
-            team_b = [i for i in range(10) if i not in team_a]
-            ta = [players[i] for i in team_a]
-            tb = [players[i] for i in team_b]
-            asg_a = valid_assignments(ta)
-            asg_b = valid_assignments(tb)
-            for sa, aa in asg_a:
-                for sb, bb in asg_b:
-                    d = abs(sa - sb)
-                    if d == 0: exact.append((sa, aa, sb, bb))
-                    elif d == 5: five.append((sa, aa, sb, bb))
-        if mode == "exact": pool, title = exact, "0점 차이"
-        elif mode == "five": pool, title = five, "5점 차이"
-        else: pool, title = (exact + five), "전체 조합"
-
-        if not pool:
-            send_to_discord_text("조건을 만족하는 조합이 없습니다."); return
-
-        picks = random.sample(pool, min(3, len(pool)))
-        send_to_discord_with_code(picks, title, "\n".join(names))
+            send([f"⚠️ 시트 '{SCORES_WS}'에서 점수를 찾지 못한 이름: {', '.join(missing)}"]); return
+        rules, err = parse_rules(rules_text, names)
+        if err:
+            send([err]); return
+
+        players = apply_lane_rules([(n, scores_map[n]) for n in names], rules)
+        if mode in STREAM_MODES:
+            objective, label = STREAM_MODES[mode]
+            title = f"{label}(차이 ≤ {max_gap})"
+            picks = find_matches(players, 3, max_gap, objective, rules=rules, slot=slot)
+            forget_draw(slot)
+        else:
+            if mode not in MODE_TITLES: mode = "all"
+            title = MODE_TITLES[mode]
+            picks = draw_mode_matches(players, mode, rules, "\n".join(names), slot=slot)
+        if not picks:
+            send(["조건을 만족하는 조합이 없습니다."]); return
+
+        send_to_discord_with_code(picks, title, "\n".join(names), send, slot, close_send)
+    except SearchRejected as e:
+        send([f"⚠️ {e}"])
     except Exception as e:
-        send_to_discord_text(f"⚠️ 내전 처리 실패: {e}")
+        send([f"⚠️ 내전 처리 실패: {e}"])
 
-def send_to_discord_json(obj):
-    """
-    GAS가 raw 포워딩을 지원하지 않아도, 내용은 반드시 나오게 폴백도 함께 보낸다.
-    (버튼은 미표시)
-    """
-    global LAST_SEND_TS
-    now = time.time()
-    wait = MIN_INTERVAL - (now - LAST_SEND_TS)
-    if wait > 0: time.sleep(wait)
-    url = f"{RELAY_BASE}?key={RELAY_KEY}"
-
-    # 1) 원래 시도 (GAS가 raw 지원하면 버튼 포함으로 보일 수 있음)
+def process_reroll_and_send(matches, title, raw_input_names, send=send_messages, slot=RELAY_SLOT, close_send=None):
     try:
-        resp = requests.post(url, json={"raw": obj}, timeout=12,
-                             headers={"Content-Type": "application/json"})
-        print(f"[RELAY-JSON] status={resp.status_code} body[:200]={resp.text[:200]!r}", file=sys.stderr)
-        # 성공이든 아니든 타임스탬프만 업데이트
-        LAST_SEND_TS = time.time()
+        send_to_discord_with_code(matches, title, raw_input_names, send, slot, close_send)
     except Exception as e:
-        print(f"[RELAY-JSON] 예외: {repr(e)}", file=sys.stderr)
+        send([f"⚠️ 다시뽑기 처리 실패: {e}"])
 
-    # 2) 무조건 텍스트 폴백도 보냄(중복 방지하려면 원한다면 환경변수로 제어)
-    text = obj.get("content") if isinstance(obj, dict) else None
-    if text:
-        send_to_discord_text(text)
-        return True
-    return False
-def send_long_to_discord(content):
-    """
-    Discord는 2000자 제한이 있으므로 길면 나눠서 전송
-    """
-    limit = 2000
-    chunks = [content[i:i+limit] for i in range(0, len(content), limit)]
-    for chunk in chunks:
-        send_to_discord_text(chunk)  # 기존에 있는 Discord 전송 함수 사용
+
+# --------------------------------
+# 페이지 캐시 (/조합코드, GET /)
+#  - (키, 점수표 버전) → (ETag, HTML). 열 명이 같은 링크를 거의 동시에 열어도 렌더링은 한 번
+#  - If-None-Match가 맞으면 304(본문 없음). Cache-Control: no-cache → 브라우저는 매번 ETag로 확인
+#  - 점수표 버전이 바뀌면 버전이 붙은 항목은 모두 버린다
+# --------------------------------
+PAGE_CACHE = OrderedDict()
+PAGE_CACHE_LOCK = threading.Lock()
+PAGE_CACHE_STATS = {"hits": 0, "misses": 0, "not_modified": 0, "version": None}
+
+def cached_page(key, render, versioned=True):
+    version = scores_version() if versioned else None
+    full_key = (key, version)
+    with PAGE_CACHE_LOCK:
+        if versioned and PAGE_CACHE_STATS["version"] != version:
+            for k in [k for k in PAGE_CACHE if k[1] is not None]:
+                del PAGE_CACHE[k]
+            PAGE_CACHE_STATS["version"] = version
+        entry = PAGE_CACHE.get(full_key)
+        if entry is not None:
+            PAGE_CACHE.move_to_end(full_key)
+            PAGE_CACHE_STATS["hits"] += 1
+    if entry is None:
+        body = render()
+        entry = (hashlib.sha1(body.encode("utf-8")).hexdigest()[:20], body)
+        with PAGE_CACHE_LOCK:
+            PAGE_CACHE_STATS["misses"] += 1
+            PAGE_CACHE[full_key] = entry
+            while len(PAGE_CACHE) > PAGE_CACHE_SIZE:
+                PAGE_CACHE.popitem(last=False)
+    etag, body = entry
+    resp = make_response(body)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp = resp.make_conditional(request)
+    if resp.status_code == 304:
+        with PAGE_CACHE_LOCK:
+            PAGE_CACHE_STATS["not_modified"] += 1
+    return resp
+
+def drop_cached_page(key):
+    """key로 캐시한 페이지를 모두(버전 무관) 버린다"""
+    with PAGE_CACHE_LOCK:
+        for k in [k for k in PAGE_CACHE if k[0] == key]:
+            del PAGE_CACHE[k]
+
+def page_cache_stats():
+    with PAGE_CACHE_LOCK:
+        return dict(PAGE_CACHE_STATS, size=len(PAGE_CACHE))
 
 # --------------------------------
 # 웹 UI (이름만)
@@ -485,51 +2650,71 @@ def index():
     if request.method == "POST":
         input_text = request.form.get("player_data", default_input)
         action = request.form.get("action")
+        if action == "reroll":
+            seed = parse_seed(request.form.get("seed"))
+            matches, title, roster = reroll_matches(seed)
+            names = parse_names_only(input_text)
+            if matches is None:
+                return render_template("index.html", error=title, default_input=input_text, names=names, positions=positions)
+            send_to_discord_with_code(matches, title, roster)
+            return render_template("index.html", result_type="random", matches=matches,
+                                   default_input=input_text, names=names, positions=positions)
         names = parse_names_only(input_text)
-        if len(names) != 10:
-            return render_template("index.html", error="⚠️ 정확히 10명의 플레이어를 입력해주세요.", default_input=input_text)
+        err = roster_error(names)
+        if err:
+            return render_template("index.html", error=err, default_input=input_text)
         scores_map = load_scores_map()
         missing = [n for n in names if n not in scores_map]
         if missing:
             return render_template("index.html",
                                    error=f"⚠️ 시트 '{SCORES_WS}'에서 점수를 찾지 못한 이름: {', '.join(missing)}",
                                    default_input=input_text, names=names, positions=positions)
-        players = [(n, scores_map[n]) for n in names]
-        exact, five = [], []
-        for ta_idx in itertools.combinations(range(10), 5):
-            tb_idx = [i for i in range(10) if i not in ta_idx]
-            ta = [players[i] for i in ta_idx]; tb = [players[i] for i in tb_idx]
-            asg_a = valid_assignments(ta); asg_b = valid_assignments(tb)
-            for sa, aa in asg_a:
-                for sb, bb in asg_b:
-                    d = abs(sa - sb)
-                    if d == 0: exact.append((sa, aa, sb, bb))
-                    elif d == 5: five.append((sa, aa, sb, bb))
-        if action == "random_exact":
-            matches = random.sample(exact, min(3, len(exact)))
-            send_to_discord_with_code(matches, "0점 차이", "\n".join(names))
-            return render_template("index.html", result_type="random", matches=matches,
-                                   default_input=input_text, names=names, positions=positions)
-        elif action == "random_five":
-            matches = random.sample(five, min(3, len(five)))
-            send_to_discord_with_code(matches, "5점 차이", "\n".join(names))
-            return render_template("index.html", result_type="random", matches=matches,
-                                   default_input=input_text, names=names, positions=positions)
-        elif action == "random_all":
-            all_matches = exact + five
-            matches = random.sample(all_matches, min(3, len(all_matches)))
-            send_to_discord_with_code(matches, "전체 조합", "\n".join(names))
+        rules, err = parse_rules(request.form.get("rules", ""), names)
+        if err:
+            return render_template("index.html", error=err, default_input=input_text, names=names, positions=positions)
+        players = apply_lane_rules([(n, scores_map[n]) for n in names], rules)
+        try:
+            if action in ("random_exact", "random_five", "random_all"):
+                mode = action[len("random_"):]
+                matches = draw_mode_matches(players, mode, rules, "\n".join(names))
+                title = MODE_TITLES[mode]
+            elif action in STREAM_MODES:
+                objective, label = STREAM_MODES[action]
+                max_gap = parse_max_gap(request.form.get("max_gap"))
+                matches = find_matches(players, 3, max_gap, objective, rules=rules)
+                forget_draw()
+                title = f"{label}(차이 ≤ {max_gap})"
+            else:
+                matches = None
+        except SearchRejected as e:
+            return render_template("index.html", error=f"⚠️ {e}", default_input=input_text, names=names, positions=positions)
+        if matches is not None:
+            send_to_discord_with_code(matches, title, "\n".join(names))
             return render_template("index.html", result_type="random", matches=matches,
                                    default_input=input_text, names=names, positions=positions)
     names = [line.strip() for line in default_input.strip().split('\n')]
-    return render_template("index.html", default_input=default_input, names=names, positions=positions)
-
+    return cached_page(("index",), lambda: render_template("index.html", default_input=default_input, names=names, positions=positions))
 
 # --------------------------------
 # 조합코드 (짧은 URL: a,b만)
 # --------------------------------
 @app.route("/조합코드")
 def combination_code():
+    mid = request.args.get("id", "").strip()
+    if mid:
+        match = get_match(mid)
+        if not match:
+            return render_template("index.html", error="⚠️ 알 수 없는 조합 ID입니다.", default_input="")
+        ta = [(positions[i], n, s) for i, (n, s) in enumerate(zip(match["a"], match["scores_a"]))]
+        tb = [(positions[i], n, s) for i, (n, s) in enumerate(zip(match["b"], match["scores_b"]))]
+        # 등록 당시 점수로 고정된 페이지 → 점수표 버전과 무관
+        return cached_page(("code", mid), lambda: render_template("index.html",
+                               default_input="\n".join(match["a"] + match["b"]),
+                               result_type="code",
+                               code_match=(sum(match["scores_a"]), ta, sum(match["scores_b"]), tb),
+                               code_value=f"id={mid}",
+                               names=(match["a"] + match["b"]),
+                               positions=positions), versioned=False)
     a_csv = request.args.get("a", ""); b_csv = request.args.get("b", "")
     if not a_csv or not b_csv:
         return render_template("index.html", error="⚠️ 정보가 부족합니다.", default_input="")
@@ -550,13 +2735,13 @@ def combination_code():
     ta, tb = build(a_names), build(b_names)
     sa, sb = sum(x[2] for x in ta), sum(x[2] for x in tb)
     code_value = f"a={','.join(a_names)}&b={','.join(b_names)}"
-    return render_template("index.html",
+    return cached_page(("code", tuple(a_names), tuple(b_names)), lambda: render_template("index.html",
                            default_input="\n".join(a_names + b_names),
                            result_type="code",
                            code_match=(sa, ta, sb, tb),
                            code_value=code_value,
                            names=(a_names + b_names),
-                           positions=positions)
+                           positions=positions))
 
 
 # --------------------------------
@@ -564,9 +2749,12 @@ def combination_code():
 # --------------------------------
 @app.route("/전송", methods=["POST"])
 def submit_result():
-    input_data = request.form.get("code_value")   # "a=...&b=..."
+    input_data = request.form.get("code_value")   # "id=..." 또는 예전 "a=...&b=..."
     a_team = request.form.get("a_team", "").split(",")
     b_team = request.form.get("b_team", "").split(",")
+    match = get_match(input_data[3:]) if (input_data or "").startswith("id=") else None
+    if match:   # 등록부의 명단이 기준
+        a_team, b_team = list(match["a"]), list(match["b"])
     winner1 = request.form.get("r1_result")       # "A"/"B"
     winner2 = request.form.get("r2_result")       # "A"/"B"/None
     if not input_data or not a_team or not b_team or not winner1:
@@ -580,32 +2768,172 @@ def submit_result():
         if winner2 == "A": rows.append([date_str, "2RD"] + a_team + b_team)
         else:              rows.append([date_str, "2RD"] + b_team + a_team)
     try:
-        client = gs_client(); sheet = get_results_ws(client)
-        for r in rows: sheet.append_row(r, value_input_option='USER_ENTERED')
-        combo_link = f"{BASE_URL}/조합코드?{input_data}"
-        pending_mark_done_by_link(combo_link)
-        return "✅ 저장 완료"
+        key = journal_key("web", date_str, input_data, winner1, winner2 or "")
+        if not journal_results(key, rows, f"{BASE_URL}/조합코드?{input_data}"):
+            return "✅ 이미 접수된 결과입니다"
+        return "✅ 저장 접수(시트에는 곧 반영됩니다)"
     except Exception as e:
         return f"⚠️ 저장 실패: {e}"
 
 
+# --------------------------------
+# 투표 저장소
+#  - create / get / vote(원자적 upsert, 닫힌 투표면 False) / close(원자적, 처음 닫은 쪽만 스냅숏을 받음)
+#  - set_current / current: 슬롯(서버:채널)마다 지금 받는 투표 하나
+#  - 투표 dict: {"pid","title","options","option_links","roster","votes":{투표자: idx},"closed","created_at"}
+# --------------------------------
+class MemoryPollStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.polls, self.currents = {}, {}
+
+    def create(self, title, options, option_links, roster=None):
+        pid = uuid.uuid4().hex
+        with self.lock:
+            self._evict(time.time())
+            self.polls[pid] = {"pid": pid, "title": title, "options": list(options), "option_links": list(option_links),
+                               "roster": list(roster or []), "votes": {}, "closed": False,
+                               "created_at": int(time.time()), "closed_at": None}
+        return pid
+
+    def get(self, pid):
+        with self.lock:
+            poll = self.polls.get(pid)
+            return dict(poll, votes=dict(poll["votes"])) if poll else None
+
+    def vote(self, pid, voter, idx):
+        with self.lock:
+            poll = self.polls.get(pid)
+            if not poll or poll["closed"]:
+                return False
+            poll["votes"][voter] = idx
+            return True
+
+    def close(self, pid):
+        with self.lock:
+            poll = self.polls.get(pid)
+            if not poll or poll["closed"]:
+                return None
+            poll.update(closed=True, closed_at=time.time())
+            return dict(poll, votes=dict(poll["votes"]))
+
+    def set_current(self, slot, pid):
+        with self.lock:
+            self.currents[slot] = pid
+
+    def current(self, slot):
+        with self.lock:
+            return self.currents.get(slot)
+
+    def _evict(self, now):
+        for pid, poll in list(self.polls.items()):
+            if (poll["closed"] and now - poll["closed_at"] > POLL_CLOSED_TTL) or now - poll["created_at"] > POLL_TTL:
+                del self.polls[pid]
+        for slot, pid in list(self.currents.items()):
+            if pid not in self.polls:
+                del self.currents[slot]
+
+    def stats(self):
+        with self.lock:
+            return {"backend": "memory", "polls": len(self.polls), "open": sum(not p["closed"] for p in self.polls.values())}
+
+class SqlitePollStore:
+    """한 파일을 여러 프로세스가 같이 쓴다. 표 upsert/종료는 SQL 한 문장이라 워커 사이에서도 원자적"""
+    def __init__(self):
+        conn = self.db()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS polls (pid TEXT PRIMARY KEY, data TEXT, closed INTEGER DEFAULT 0,
+                                                  created_at REAL, closed_at REAL);
+                CREATE TABLE IF NOT EXISTS votes (pid TEXT, voter TEXT, idx INTEGER, PRIMARY KEY (pid, voter));
+                CREATE TABLE IF NOT EXISTS currents (slot TEXT PRIMARY KEY, pid TEXT);""")
+        finally:
+            conn.close()
+
+    def db(self):
+        return sqlite3.connect(POLL_DB, timeout=10)
+
+    def _run(self, fn):
+        conn = self.db()
+        try:
+            with conn:   # 트랜잭션(예외 시 롤백)
+                return fn(conn)
+        finally:
+            conn.close()
+
+    def create(self, title, options, option_links, roster=None):
+        pid = uuid.uuid4().hex
+        data = json.dumps({"title": title, "options": list(options), "option_links": list(option_links),
+                           "roster": list(roster or [])}, ensure_ascii=False)
+        def run(conn):
+            self._evict(conn, time.time())
+            conn.execute("INSERT INTO polls(pid, data, created_at) VALUES (?,?,?)", (pid, data, int(time.time())))
+        self._run(run)
+        return pid
+
+    def _load(self, conn, pid):
+        row = conn.execute("SELECT data, closed, created_at, closed_at FROM polls WHERE pid=?", (pid,)).fetchone()
+        if not row:
+            return None
+        votes = dict(conn.execute("SELECT voter, idx FROM votes WHERE pid=?", (pid,)).fetchall())
+        return dict(json.loads(row[0]), pid=pid, votes=votes, closed=bool(row[1]), created_at=int(row[2]), closed_at=row[3])
+
+    def get(self, pid):
+        return self._run(lambda conn: self._load(conn, pid))
+
+    def vote(self, pid, voter, idx):
+        cur = self._run(lambda conn: conn.execute(
+            "INSERT INTO votes(pid, voter, idx) SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM polls WHERE pid=? AND closed=0) "
+            "ON CONFLICT(pid, voter) DO UPDATE SET idx=excluded.idx", (pid, voter, idx, pid)))
+        return cur.rowcount == 1
+
+    def close(self, pid):
+        def run(conn):
+            cur = conn.execute("UPDATE polls SET closed=1, closed_at=? WHERE pid=? AND closed=0", (time.time(), pid))
+            return self._load(conn, pid) if cur.rowcount == 1 else None   # 닫힌 뒤라 표가 더 들어오지 않는다
+        return self._run(run)
+
+    def set_current(self, slot, pid):
+        self._run(lambda conn: conn.execute("INSERT OR REPLACE INTO currents VALUES (?,?)", (slot, pid)))
+
+    def current(self, slot):
+        row = self._run(lambda conn: conn.execute("SELECT pid FROM currents WHERE slot=?", (slot,)).fetchone())
+        return row[0] if row else None
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM polls WHERE (closed=1 AND closed_at < ?) OR created_at < ?",
+                     (now - POLL_CLOSED_TTL, now - POLL_TTL))
+        conn.execute("DELETE FROM votes WHERE pid NOT IN (SELECT pid FROM polls)")
+        conn.execute("DELETE FROM currents WHERE pid NOT IN (SELECT pid FROM polls)")
+
+    def stats(self):
+        total, open_ = self._run(lambda conn: conn.execute("SELECT COUNT(*), SUM(closed=0) FROM polls").fetchone())
+        return {"backend": "sqlite", "polls": total, "open": open_ or 0}
+
+POLL_STORES = {"memory": MemoryPollStore, "sqlite": SqlitePollStore}
+POLL_STATE = {"store": None}
+POLL_STATE_LOCK = threading.Lock()
+
+def poll_store():
+    with POLL_STATE_LOCK:
+        if POLL_STATE["store"] is None:
+            POLL_STATE["store"] = POLL_STORES.get(POLL_STORE, MemoryPollStore)()
+        return POLL_STATE["store"]
+
+
 # --------------------------------
 # 웹 폼 투표(기존)
 # --------------------------------
-def _make_poll(title, options, option_links):
-    pid = uuid.uuid4().hex
-    POLLS[pid] = {"title":title, "options":list(options), "option_links":list(option_links),
-                  "votes":{}, "closed":False, "created_at":int(time.time())}
-    return pid
-def make_poll_links(title, options, option_links):
-    pid = _make_poll(title, options, option_links)
+def make_poll_links(title, options, option_links, roster=None):
+    pid = poll_store().create(title, options, option_links, roster)
     return f"{BASE_URL}/vote?pid={pid}", f"{BASE_URL}/vote/end?pid={pid}"
 
 @app.route("/vote", methods=["GET","POST"])
 def vote_page():
     pid = request.args.get("pid","")
-    if not pid or pid not in POLLS: return "⚠️ 잘못된 링크입니다.", 400
-    poll = POLLS[pid]
+    poll = poll_store().get(pid) if pid else None
+    if not poll: return "⚠️ 잘못된 링크입니다.", 400
     if poll.get("closed"): return "⛔ 이미 종료된 투표입니다."
     if request.method=="POST":
         voter = (request.form.get("voter") or "").strip()
@@ -613,7 +2941,7 @@ def vote_page():
         if not voter or choice is None or not choice.isdigit(): return "⚠️ 닉네임과 선택지를 올바르게 입력하세요.", 400
         idx = int(choice)
         if idx<0 or idx>=len(poll["options"]): return "⚠️ 유효하지 않은 선택지입니다.", 400
-        poll["votes"][voter]=idx
+        if not poll_store().vote(pid, voter, idx): return "⛔ 이미 종료된 투표입니다."
         return f"✅ {voter} 님의 투표가 저장되었습니다. (다시 투표하면 최신 표로 갱신됩니다)"
     opts = poll["options"]
     radios = "<br>".join([f'<label><input type="radio" name="choice" value="{i}" {"required" if i==0 else ""}> {label}</label>' for i,label in enumerate(opts)])
@@ -623,8 +2951,8 @@ def vote_page():
 @app.route("/vote/end", methods=["GET"])
 def vote_end_page():
     pid = request.args.get("pid","")
-    if not pid or pid not in POLLS: return "⚠️ 잘못된 링크입니다.", 400
-    poll = POLLS[pid]
+    poll = poll_store().get(pid) if pid else None
+    if not poll: return "⚠️ 잘못된 링크입니다.", 400
     if poll.get("closed"): return "⛔ 이미 종료된 투표입니다."
     return f"""<h2>⏹️ 투표 종료 — {poll['title']}</h2>
     <p>정말 종료하시겠습니까? 종료 시 결과가 디스코드로 공지됩니다.</p>
@@ -633,9 +2961,9 @@ def vote_end_page():
 @app.route("/vote/end/confirm", methods=["POST"])
 def vote_end_confirm():
     pid = request.form.get("pid","")
-    if not pid or pid not in POLLS: return "⚠️ 잘못된 요청입니다.", 400
-    poll = POLLS[pid]
-    if poll.get("closed"): return "⛔ 이미 종료된 투표입니다."
+    if not pid or not poll_store().get(pid): return "⚠️ 잘못된 요청입니다.", 400
+    poll = poll_store().close(pid)   # 여러 워커/중복 클릭 중 처음 닫은 요청만 공지
+    if poll is None: return "⛔ 이미 종료된 투표입니다."
     unresolved = pending_fetch_unrecorded()
     counts = defaultdict(int)
     for _, idx in poll["votes"].items():
@@ -659,14 +2987,15 @@ def vote_end_confirm():
         a_names, b_names = _parse_names_from_code_link(result_link)
         ten = a_names + b_names if (len(a_names)==5 and len(b_names)==5) else []
         recorder = random.choice(ten) if ten else "기록담당(무작위 실패)"
+        note_bench(poll.get("roster"), ten)
         lines.append(f"🧾 **승/패 기록 링크**: {result_link}")
         lines.append(f"📝 **오늘의 기록담당**: {recorder}")
         pending_add(result_link)
+    flush_writes()
     try:
         send_long_to_discord("\n".join(lines))
     except Exception as e:
         return f"⚠️ 디스코드 전송 실패: {e}", 500
-    poll["closed"]=True
     return "✅ 결과를 디스코드로 공지했습니다. (이 페이지는 닫아도 됩니다)"
 
 
@@ -680,6 +3009,18 @@ def pending_list():
     items = "".join([f"<li>{urllib.parse.quote(link, safe=':/?=&,')} <form style='display:inline' method='POST' action='/pending/resolve'><input type='hidden' name='link' value='{link}'><button type='submit'>해결</button></form></li>" for link in links])
     return f"<h3>미기록 조합 목록</h3><ul>{items}</ul>"
 
+def admin_ok():
+    """쿼리 문자열은 접근 로그에 남으므로 헤더만 본다"""
+    given = request.headers.get("X-Admin-Key") or ""
+    return bool(ADMIN_KEY) and hmac.compare_digest(given.encode("utf-8"), ADMIN_KEY.encode("utf-8"))
+
+@app.route("/pending/compact", methods=["POST"])
+def pending_compact():
+    if not admin_ok():
+        return "⚠️ 관리 키가 필요합니다.", 403
+    moved = compact_pending()
+    return f"✅ 정리 완료: Done {moved}건 → {PENDING_ARCHIVE_WS}"
+
 @app.route("/pending/resolve", methods=["POST"])
 def pending_resolve():
     link = request.form.get("link","")
@@ -694,17 +3035,84 @@ def pending_resolve():
 @app.route("/webhook_test")
 def webhook_test():
     txt = request.args.get("msg", "테스트 메시지 입니다.")
-    ok = send_to_discord_text(f"[테스트] {txt}")
+    try:
+        ok = all(send_to_discord_text(f"[테스트] {txt}").result(timeout=30))
+    except Exception:
+        ok = False
     return ("✅ 전송 성공" if ok else "❌ 전송 실패, error log 확인"), (200 if ok else 500)
 
+@app.route("/stats")
+def stats():
+    return {"match_cache": match_cache_stats(), "scores": scores_cache_stats(), "sheets": sheets_stats(),
+            "journal": journal_stats(), "mirror": mirror_stats(), "relay": relay_stats(), "jobs": job_stats(),
+            "polls": dict(poll_store().stats(), **scheduler_stats()), "pages": page_cache_stats()}
+
+@app.route("/jobs")
+def jobs_list():
+    with JOBS_LOCK:
+        return {"jobs": [_job_view(j) for j in reversed(JOBS.values())]}
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    return job if job else ({"error": "작업을 찾을 수 없습니다."}, 404)
+
+
+# --------------------------------
+# 전적 조회(로컬 미러)
+#  - /history?name=이름&limit=20
+#  - 미러가 오래됐으면 백그라운드 증분 동기화만 걸고 지금 있는 값으로 바로 답한다
+# --------------------------------
+@app.route("/history")
+def history():
+    name = (request.args.get("name") or "").strip()
+    if not name:
+        return "⚠️ name이 필요합니다.", 400
+    raw = (request.args.get("limit") or "").strip()
+    limit = min(max(1, int(raw)), 200) if re.fullmatch(r"-?[0-9]+", raw) else 20   # 음수 LIMIT은 SQLite에서 무제한
+    mirror_refresh_results()
+    h = player_history(name, limit)
+    total = h["wins"] + h["losses"]
+    rate = f"{h['wins'] * 100 / total:.0f}%" if total else "-"
+    lines = [f"{name}: {h['wins']}승 {h['losses']}패 (승률 {rate})"]
+    for date, rnd, wl, mine, theirs in h["recent"]:
+        lines.append(f"{date} {rnd} {wl}  [{', '.join(mine)}] vs [{', '.join(theirs)}]")
+    return "<pre>" + str(escape("\n".join(lines))) + "</pre>"
+
+@app.route("/history/sync", methods=["POST"])
+def history_sync():
+    full = request.args.get("full") == "1"
+    if full and not admin_ok():   # 증분 동기화는 가볍고, 전체 재동기화만 관리 키
+        return "⚠️ 관리 키가 필요합니다.", 403
+    try:
+        added = mirror_sync_results(full=full)
+    except Exception as e:
+        return f"⚠️ 동기화 실패: {e}", 502
+    return f"✅ 결과 미러 동기화: {added}경기 추가"
+
+
+# --------------------------------
+# 점수표 갱신(시트 수정 직후)
+# --------------------------------
+@app.route("/scores/refresh", methods=["POST"])
+def scores_refresh():
+    if not admin_ok():
+        return "⚠️ 관리 키가 필요합니다.", 403
+    invalidate_scores()
+    data = refresh_scores(force=True)
+    return f"✅ 점수표 갱신 완료 ({len(data)}명, v{scores_version()})"
+
 
 # --------------------------------
 # Discord Interactions (Slash & Buttons)
 #  - /테스트핑
-#  - /내전 members:<이름10줄> mode:<all|exact|five>
+#  - /내전 members:<이름 10~N줄> mode:<all|exact|five|best|skill|near|first> gap:<허용 차이, 선택>
+#         rules:<조건, 선택: 두낫=정글 밈밈!=서폿 A+B A/B>
+#  - /다시 seed:<정수, 선택>
+#  - /점수갱신
 #  - /투표 choice:<1|2|3>
 #  - /공개
-#  - Buttons custom_id: res|<round:1|2>|<result:A|B|N>|<encoded_link>
+#  - Buttons custom_id: res|<round:1|2>|<result:A|B|N>|<조합 ID(예전 메시지는 encoded_link)>
 # --------------------------------
 @app.route("/discord", methods=["POST"])
 def discord_interactions():
@@ -730,13 +3138,44 @@ def discord_interactions():
             opts = {o.get("name"): o.get("value") for o in (data.get("options") or [])}
             members_text = (opts.get("members") or "").strip()
             mode = (opts.get("mode") or "all").lower()
+            max_gap = parse_max_gap(opts.get("gap"))
+            rules_text = (opts.get("rules") or "").strip()
             if not members_text:
                 return {"type": 4, "data": {"content": "⚠️ 멤버 목록을 입력하세요.", "flags": 64}}
+            # 같은 명단(순서 무관)/모드/조건이면 진행 중인 작업 하나를 같이 본다
+            key = ("내전", interaction_slot(payload), tuple(sorted(parse_names_only(normalize_members_text(members_text)))), mode, max_gap, rules_text)
             try:
-                threading.Thread(target=process_match_and_send, args=(members_text, mode), daemon=True).start()
-            except Exception as e:
-                return {"type": 4, "data": {"content": f"⚠️ 작업 시작 실패: {e}", "flags": 64}}
-            return {"type": 4, "data": {"content": "⏳ 요청 접수! 곧 채널에 결과 올릴게요. ", "flags": 64}}
+                job, new = submit_job("내전", process_match_and_send,
+                                      (members_text, mode, max_gap, rules_text, followup_sender(payload),
+                                       interaction_slot(payload), followup_sender(payload, edit_original=False)), key=key)
+            except JobRejected as e:
+                return {"type": 4, "data": {"content": f"⚠️ {e}", "flags": 64}}
+            if not new:
+                return {"type": 4, "data": {"content": f"⏳ 같은 요청이 이미 진행 중입니다(작업 {job['id']}). 곧 채널에 올라옵니다.", "flags": 64}}
+            return {"type": 5}
+
+        # /점수갱신 — 시트에서 점수를 고친 뒤 캐시 무효화
+        if cmd_name == "점수갱신":
+            invalidate_scores()
+            try:
+                submit_job("점수갱신", refresh_scores, (True,), key=("점수갱신",))
+            except JobRejected as e:
+                return {"type": 4, "data": {"content": f"⚠️ {e}", "flags": 64}}
+            return {"type": 4, "data": {"content": "🔄 점수표를 다시 불러옵니다.", "flags": 64}}
+
+        # /다시 seed:<정수, 선택> — 마지막 풀에서 보여주지 않은 조합 3개 더
+        if cmd_name == "다시":
+            opts = {o.get("name"): o.get("value") for o in (data.get("options") or [])}
+            seed = parse_seed(opts.get("seed"))
+            matches, title, roster = reroll_matches(seed, slot=interaction_slot(payload))
+            if matches is None:
+                return {"type": 4, "data": {"content": title, "flags": 64}}
+            try:
+                submit_job("다시", process_reroll_and_send, (matches, title, roster, followup_sender(payload),
+                                                             interaction_slot(payload), followup_sender(payload, edit_original=False)))
+            except JobRejected as e:
+                return {"type": 4, "data": {"content": f"⚠️ {e}", "flags": 64}}
+            return {"type": 5}
 
         # /투표 choice:<1|2|3>
         if cmd_name == "투표":
@@ -745,39 +3184,41 @@ def discord_interactions():
             if choice_raw not in ["1","2","3"]:
                 return {"type": 4, "data": {"content": "⚠️ choice는 1/2/3 중 하나여야 합니다.", "flags": 64}}
             idx = int(choice_raw) - 1
-            with POLL_LOCK:
-                if not CURRENT_POLL["option_links"]:
-                    return {"type": 4, "data": {"content": "⚠️ 현재 투표 가능한 조합이 없습니다. 먼저 /내전 으로 생성하세요.", "flags": 64}}
-                if idx < 0 or idx >= len(CURRENT_POLL["option_links"]):
-                    return {"type": 4, "data": {"content": "⚠️ 유효하지 않은 선택지입니다.", "flags": 64}}
-                # 사용자 ID로 익명 집계
-                user_id = None
-                if "member" in payload and payload["member"].get("user"):
-                    user_id = payload["member"]["user"].get("id")
-                if not user_id and payload.get("user"):
-                    user_id = payload["user"].get("id")
-                if not user_id:
-                    user_id = uuid.uuid4().hex  # 최후의 수단(진짜 익명)
-                CURRENT_POLL["votes"][user_id] = idx
+            store = poll_store()
+            pid = current_poll_id(interaction_slot(payload))
+            poll = store.get(pid) if pid else None
+            if not poll or poll["closed"]:
+                return {"type": 4, "data": {"content": "⚠️ 현재 투표 가능한 조합이 없습니다. 먼저 /내전 으로 생성하세요.", "flags": 64}}
+            if idx < 0 or idx >= len(poll["option_links"]):
+                return {"type": 4, "data": {"content": "⚠️ 유효하지 않은 선택지입니다.", "flags": 64}}
+            # 사용자 ID로 익명 집계
+            user_id = None
+            if "member" in payload and payload["member"].get("user"):
+                user_id = payload["member"]["user"].get("id")
+            if not user_id and payload.get("user"):
+                user_id = payload["user"].get("id")
+            if not user_id:
+                user_id = uuid.uuid4().hex  # 최후의 수단(진짜 익명)
+            if not store.vote(pid, user_id, idx):
+                return {"type": 4, "data": {"content": "⛔ 이미 공개된 투표입니다.", "flags": 64}}
             return {"type": 4, "data": {"content": f"✅ 투표 저장: {choice_raw}번", "flags": 64}}
 
         # /공개
         if cmd_name == "공개":
-            with POLL_LOCK:
-                if not CURRENT_POLL["option_links"]:
-                    return {"type": 4, "data": {"content": "⚠️ 공개할 투표가 없습니다.", "flags": 64}}
-                snap_options = CURRENT_POLL["options"][:]
-                snap_links   = CURRENT_POLL["option_links"][:]
-                snap_votes   = dict(CURRENT_POLL["votes"])
-                CURRENT_POLL["options"].clear()
-                CURRENT_POLL["option_links"].clear()
-                CURRENT_POLL["votes"].clear()
-                CURRENT_POLL["created_at"] = 0
+            slot = interaction_slot(payload)
+            with slot_lock(slot):
+                pid = current_poll_id(slot)
+                owner = slot if poll_store().current(slot) == pid else RELAY_SLOT   # 릴레이 채널 투표로 넘어간 경우
+                snap = poll_store().close(pid) if pid else None   # 동시에 /공개가 와도 한 번만
+            if not snap:
+                return {"type": 4, "data": {"content": "⚠️ 공개할 투표가 없습니다.", "flags": 64}}
             try:
-                threading.Thread(target=_publish_poll_snapshot_async, args=(snap_options, snap_links, snap_votes), daemon=True).start()
-            except Exception as e:
-                return {"type": 4, "data": {"content": f"⚠️ 작업 시작 실패: {e}", "flags": 64}}
-            return {"type": 4, "data": {"content": "📣 결과를 채널에 공개 중입니다!", "flags": 64}}
+                submit_job("공개", _publish_poll_snapshot_async,
+                           (snap["options"], snap["option_links"], snap["votes"], snap["roster"], followup_sender(payload),
+                            owner))
+            except JobRejected as e:
+                return {"type": 4, "data": {"content": f"⚠️ {e}", "flags": 64}}
+            return {"type": 5}
 
         return {"type": 4, "data": {"content": f"알 수 없는 명령: {cmd_name}", "flags": 64}}
 
@@ -785,11 +3226,12 @@ def discord_interactions():
     if payload.get("type") == 3:
         data = payload.get("data", {})
         custom_id = (data.get("custom_id") or "").strip()
-        # 형식: res|<round:1|2>|<result:A|B|N>|<encoded_link>
+        # 형식: res|<round:1|2>|<result:A|B|N>|<조합 ID 또는 encoded_link>
         if custom_id.startswith("res|"):
             try:
-                _, rnd, res, enc = custom_id.split("|", 3)
-                link = urllib.parse.unquote_plus(enc)
+                _, rnd, res, ref = custom_id.split("|", 3)
+                # ref: 조합 ID, 또는 예전 메시지의 인코딩된 링크
+                link = urllib.parse.unquote_plus(ref) if "%" in ref or "://" in ref else match_link(ref)
                 a_names, b_names = _parse_names_from_code_link(link)
                 if len(a_names) != 5 or len(b_names) != 5:
                     return {"type": 4, "data": {"content": "⚠️ 링크 파싱 실패(팀 구성 오류).", "flags": 64}}
@@ -812,9 +3254,10 @@ def discord_interactions():
 
                 if rows:
                     try:
-                        client = gs_client(); sheet = get_results_ws(client)
-                        for r in rows: sheet.append_row(r, value_input_option='USER_ENTERED')
-                        pending_mark_done_by_link(link)
+                        # 같은 메시지의 같은 라운드는 한 번만 기록(어느 팀 버튼이든)
+                        msg_id = (payload.get("message") or {}).get("id") or date_str
+                        if not journal_results(journal_key("res", msg_id, rnd, link), rows, link):
+                            return {"type": 4, "data": {"content": f"ℹ️ {rnd}R 결과는 이미 기록되었습니다.", "flags": 64}}
                         return {"type": 4, "data": {"content": f"✅ {rnd}R 결과 저장 완료({res}).", "flags": 64}}
                     except Exception as e:
                         return {"type": 4, "data": {"content": f"⚠️ 저장 실패: {e}", "flags": 64}}
@@ -0,0 +1,25 @@
+import math, random, os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+
+# 고정 로스터(이름, [탑, 정글, 미드, 원딜, 서폿] 점수)
+PLAYERS = [
+    ("p0", [10, 15, 5, 20, 0]), ("p1", [20, 5, 15, 10, 25]), ("p2", [0, 25, 10, 5, 15]),
+    ("p3", [15, 10, 20, 25, 5]), ("p4", [5, 20, 0, 15, 10]), ("p5", [25, 0, 5, 10, 20]),
+    ("p6", [10, 10, 15, 5, 0]), ("p7", [5, 15, 25, 20, 10]), ("p8", [20, 25, 10, 0, 5]),
+    ("p9", [15, 5, 0, 10, 25]),
+]
+DRAWS = 2000
+
+
+@pytest.mark.parametrize("mode", sorted(app.MODE_GAPS))
+def test_sampler_matches_full_pool(mode):
+    """표본 엔진의 (sa, sb) 분포가 전수 풀과 같아야 한다(균등 추출)"""
+    report = app.sampler_distribution_report(PLAYERS, mode, DRAWS, random.Random(0))
+    assert report["pool_size"] > 0 and report["draws"] == DRAWS
+    # 카이제곱: 자유도 + 4σ(≈ p < 0.001) 안, TV 거리: 표본 잡음 수준
+    assert report["chi2"] < report["dof"] + 4 * math.sqrt(2 * report["dof"])
+    assert report["tv_distance"] < 0.1